@@ -0,0 +1,321 @@
+"""
+a non-blocking front-end of the decoder. `AsyncDecoder.decode` queues a query and returns a
+`DecodeFuture` at once, a decoding thread decodes the queued queries in batches, e.g.
+
+decoder = AsyncDecoder(model, grammar, annot_vocab, terminal_vocab)
+futures = [decoder.decode(query, deadline=time.time() + 1.) for query in queries]
+cand_lists = gather(futures)
+"""
+import sys
+import time
+import logging
+import threading
+import Queue
+from collections import namedtuple, deque
+
+import config
+from dataset import canonicalize_query, query_to_data
+from components import DecodeBudget
+
+Example = namedtuple('example', ['query', 'data'])
+
+
+class DecodeCancelled(Exception):
+    pass
+
+
+class DecodeFuture(object):
+    """
+    the pending result of decoding a query, which is 'pending' in the queue, 'running',
+    'finished' or 'cancelled'. `result` gives the list of candidates, sorted by score
+    """
+    def __init__(self, query, str_map, example, beam_size, budget):
+        self.query = query
+        self.str_map = str_map
+        self.example = example
+        self.beam_size = beam_size
+        self.budget = budget
+
+        self.state = 'pending'
+        self.cand_list = None
+        self.error = None
+        # the exception of the decoding thread with its traceback, from `sys.exc_info`
+        self.exc_info = None
+        self.callbacks = []
+        self.cond = threading.Condition()
+
+    def cancel(self):
+        """
+        cancel decoding, return False if it is already done. a running query stops
+        before the next decoder step
+        """
+        with self.cond:
+            if self.state in ['finished', 'cancelled']:
+                return False
+
+            self.budget.cancel()
+            if self.state == 'running':
+                return True
+
+        self.budget.finish('cancelled')
+        self.set_done('cancelled')
+
+        return True
+
+    def set_running(self):
+        """
+        return False if the query is cancelled before it is decoded
+        """
+        with self.cond:
+            if self.state != 'pending':
+                return False
+
+            self.state = 'running'
+
+        return True
+
+    def set_done(self, state, cand_list=None, exc_info=None):
+        with self.cond:
+            if self.state in ['finished', 'cancelled']:
+                return
+
+            self.state = state
+            self.cand_list = cand_list
+            if exc_info is not None:
+                self.exc_info = exc_info
+                self.error = exc_info[1]
+            self.cond.notify_all()
+
+        for callback in self.callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logging.exception('fail to call the callback of decoding [%s]', self.query)
+
+    def done(self):
+        return self.state in ['finished', 'cancelled']
+
+    def cancelled(self):
+        return self.state == 'cancelled'
+
+    def running(self):
+        return self.state == 'running'
+
+    def wait(self, timeout=None):
+        """
+        wait for at most `timeout` seconds until done, return whether it is done
+        """
+        with self.cond:
+            if timeout is None:
+                while not self.done():
+                    # wait with a timeout so that the main thread can be interrupted
+                    self.cond.wait(1.)
+            else:
+                end_time = time.time() + timeout
+                while not self.done():
+                    remaining_time = end_time - time.time()
+                    if remaining_time <= 0:
+                        break
+                    self.cond.wait(remaining_time)
+
+            return self.done()
+
+    def result(self, timeout=None):
+        """
+        the list of candidates, raise `DecodeCancelled` if cancelled and the exception
+        of decoding if failed. the candidates completed so far if the deadline is hit
+        """
+        if not self.wait(timeout):
+            raise RuntimeError('decoding [%s] is not done in %.3fs' % (self.query, timeout))
+
+        if self.state == 'cancelled':
+            raise DecodeCancelled(self.query)
+
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+        return self.cand_list
+
+    def add_done_callback(self, callback):
+        """
+        call `callback(future)` once done, in the decoding thread, or at once if done already
+        """
+        with self.cond:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+
+        callback(self)
+
+
+class AsyncDecoder(object):
+    """
+    queue the queries and decode them in a thread. The queue holds at most `max_queue_size`
+    queries, more calls to `decode` block until there is room, or raise `Queue.Full` if not
+    blocking. A cancelled query leaves the queue at once. The queued queries with the same beam
+    size are decoded together, up to `max_batch_size` at a time. The compiled Theano functions
+    are not thread safe, so a model is only used by one decoding thread
+    """
+    def __init__(self, model, grammar, annot_vocab, terminal_vocab,
+                 max_queue_size=100, max_batch_size=None, max_time_step=None):
+        self.model = model
+        self.grammar = grammar
+        self.annot_vocab = annot_vocab
+        self.terminal_vocab = terminal_vocab
+
+        self.max_queue_size = max(max_queue_size, 1)
+        self.max_batch_size = max_batch_size or config.decode_batch_size
+        self.max_time_step = max_time_step or config.decode_max_time_step
+
+        # the queued futures, and whether new queries are refused, guarded by `cond`
+        self.pending = deque()
+        self.closed = False
+        self.cond = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run, name='async_decoder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decode(self, query, beam_size=None, deadline=None, timeout=None, max_expansion_num=None,
+               block=True, queue_timeout=None):
+        """
+        queue a query to decode with `beam_size`, return a `DecodeFuture`. Decoding stops at the
+        absolute time `deadline` or `timeout` seconds from now, whichever is earlier, with the
+        candidates completed so far
+        """
+        query, str_map = canonicalize_query(query)
+        query_tokens = query.split(' ')
+        query_tokens_data = [query_to_data(query, self.annot_vocab)]
+        example = Example(query=query_tokens, data=query_tokens_data)
+
+        budget = DecodeBudget(deadline=deadline, timeout=timeout, max_expansion_num=max_expansion_num)
+        future = DecodeFuture(query, str_map, example, beam_size or config.beam_size, budget)
+
+        with self.cond:
+            end_time = None if queue_timeout is None else time.time() + queue_timeout
+            while not self.closed and len(self.pending) >= self.max_queue_size:
+                if not block:
+                    raise Queue.Full
+
+                if end_time is None:
+                    self.cond.wait(1.)
+                else:
+                    remaining_time = end_time - time.time()
+                    if remaining_time <= 0:
+                        raise Queue.Full
+                    self.cond.wait(remaining_time)
+
+            if self.closed:
+                raise RuntimeError('the decoder is closed')
+
+            self.pending.append(future)
+            self.cond.notify_all()
+
+        # free the slot of the query in the queue once it is cancelled
+        future.add_done_callback(self.discard)
+
+        return future
+
+    def decode_all(self, queries, **kwargs):
+        """
+        decode the queries concurrently, return the list of candidates of each query
+        """
+        return gather([self.decode(query, **kwargs) for query in queries])
+
+    @property
+    def queue_depth(self):
+        return len(self.pending)
+
+    def discard(self, future):
+        with self.cond:
+            if future in self.pending:
+                self.pending.remove(future)
+                self.cond.notify_all()
+
+    def next_batch(self):
+        """
+        take the queued futures with the beam size of the oldest one, None once closed and
+        all the queued futures are taken
+        """
+        with self.cond:
+            while not self.pending:
+                if self.closed:
+                    return None
+                self.cond.wait()
+
+            beam_size = self.pending[0].beam_size
+            batch = [future for future in self.pending if future.beam_size == beam_size][:self.max_batch_size]
+            for future in batch:
+                self.pending.remove(future)
+            self.cond.notify_all()
+
+        return [future for future in batch if future.set_running()]
+
+    def run(self):
+        try:
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    break
+                if batch:
+                    self.decode_batch(batch)
+        finally:
+            # fail the queries that are never decoded, if the thread ends on an error
+            with self.cond:
+                self.closed = True
+                futures = list(self.pending)
+                self.pending.clear()
+                self.cond.notify_all()
+
+            for future in futures:
+                try:
+                    raise RuntimeError('the decoder is closed')
+                except RuntimeError:
+                    future.set_done('finished', exc_info=sys.exc_info())
+
+    def decode_batch(self, batch):
+        try:
+            cand_lists = self.model.decode_batch([future.example for future in batch],
+                                                 self.grammar, self.terminal_vocab,
+                                                 beam_size=batch[0].beam_size,
+                                                 max_time_step=self.max_time_step,
+                                                 budgets=[future.budget for future in batch])
+        except Exception:
+            logging.exception('fail to decode a batch of %d queries', len(batch))
+            exc_info = sys.exc_info()
+            for future in batch:
+                future.set_done('finished', exc_info=exc_info)
+            return
+
+        for future, cand_list in zip(batch, cand_lists):
+            if future.budget.status == 'cancelled':
+                future.set_done('cancelled')
+            else:
+                future.set_done('finished', cand_list=cand_list)
+
+    def close(self, wait=True):
+        """
+        stop taking queries, decode the queued ones, and wait for the decoding thread if `wait`
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        if wait:
+            while self.thread.is_alive():
+                self.thread.join(1.)
+
+
+def gather(futures, timeout=None):
+    """
+    wait for all the futures, return their results in order. `timeout` is the total
+    seconds to wait
+    """
+    end_time = None if timeout is None else time.time() + timeout
+
+    results = []
+    for future in futures:
+        remaining_time = None if end_time is None else max(end_time - time.time(), 0.)
+        results.append(future.result(remaining_time))
+
+    return results
@@ -0,0 +1,163 @@
+import time
+import logging
+
+import numpy as np
+
+import config
+
+
+def time_decoder_steps(model, decode_func, *args):
+    """
+    run `decode_func(*args)` and record the time of each call to `model.decoder_step`.
+    return the decoding results, the step times and the total decoding time
+    """
+    step_times = []
+    decoder_step = model.decoder_step
+
+    def timed_decoder_step(*step_args, **step_kwargs):
+        begin_time = time.time()
+        outputs = decoder_step(*step_args, **step_kwargs)
+        step_times.append(time.time() - begin_time)
+
+        return outputs
+
+    model.decoder_step = timed_decoder_step
+    try:
+        begin_time = time.time()
+        results = decode_func(*args)
+        decode_time = time.time() - begin_time
+    finally:
+        del model.decoder_step
+
+    return results, step_times, decode_time
+
+
+def decode_top_cands(model, dataset):
+    from decoder import decode_dataset_in_batches
+
+    return [cand_list[0] if cand_list else None for example, cand_list in decode_dataset_in_batches(model, dataset)]
+
+
+def report_step_times(name, step_times, decode_time):
+    logging.info('%s: %d steps, avg. step time %.2fms, decoding time %.2fs',
+                 name, len(step_times), np.average(step_times) * 1000, decode_time)
+
+
+def report_saving(name, base_step_times, step_times):
+    base_step_time = np.average(base_step_times)
+    step_time = np.average(step_times)
+    logging.info('per-step saving of the %s: %.2fms (%.1f%%)', name,
+                 (base_step_time - step_time) * 1000, (base_step_time - step_time) / base_step_time * 100)
+
+
+def same_top_cand_num(top_cands, other_top_cands):
+    return sum(1 for cand, other_cand in zip(top_cands, other_top_cands)
+               if cand is not None and other_cand is not None and cand.actions == other_cand.actions)
+
+
+def benchmark_rule_softmax(model, dataset):
+    """
+    compare the decoder steps with the rule softmax over all the rules and the one
+    restricted to the legal rules of the frontier node. the model must be built
+    with `config.restricted_rule_softmax`
+    """
+    grammar = dataset.grammar
+    legal_rule_nums = [len(rule_ids) for rule_ids in grammar.lhs_rule_ids if len(rule_ids) > 0]
+
+    logging.info('benchmark rule softmax on [%s] set, num. examples: %d', dataset.name, dataset.count)
+    logging.info('rule num.: %d, avg. legal rule num. per node type: %.1f, max: %d',
+                 len(grammar), np.average(legal_rule_nums), max(legal_rule_nums))
+
+    restricted_rule_softmax = config.restricted_rule_softmax
+    results = dict()
+    try:
+        for restricted in [False, True]:
+            config.restricted_rule_softmax = restricted
+            results[restricted] = time_decoder_steps(model, decode_top_cands, model, dataset)
+    finally:
+        config.restricted_rule_softmax = restricted_rule_softmax
+
+    for restricted in [False, True]:
+        top_cands, step_times, decode_time = results[restricted]
+        report_step_times('restricted rule softmax' if restricted else 'full rule softmax', step_times, decode_time)
+
+    report_saving('restricted rule softmax', results[False][1], results[True][1])
+
+    # the restricted softmax is normalized over fewer rules, which may change the ranking
+    logging.info('examples with the same top candidate: %d/%d',
+                 same_top_cand_num(results[False][0], results[True][0]), dataset.count)
+
+
+def benchmark_vocab_shortlist(model, dataset):
+    """
+    compare the decoding with the token head over the whole terminal vocab and the one
+    over the vocab shortlist of each query, in both speed and accuracy. the model must
+    be built with `config.vocab_shortlist_size`
+    """
+    from decoder import decode_python_dataset
+    from evaluation import evaluate_decode_results
+
+    vocab_shortlist_size = config.vocab_shortlist_size
+    logging.info('benchmark vocab shortlist of size %d on [%s] set, num. examples: %d',
+                 vocab_shortlist_size, dataset.name, dataset.count)
+    logging.info('terminal vocab size: %d', dataset.terminal_vocab.size)
+
+    results = dict()
+    try:
+        for shortlist_size in [0, vocab_shortlist_size]:
+            config.vocab_shortlist_size = shortlist_size
+            if config.data_type == 'ifttt':
+                results[shortlist_size] = time_decoder_steps(model, decode_top_cands, model, dataset)
+            else:
+                results[shortlist_size] = time_decoder_steps(model, decode_python_dataset, model, dataset, False)
+    finally:
+        config.vocab_shortlist_size = vocab_shortlist_size
+
+    for shortlist_size in [0, vocab_shortlist_size]:
+        decode_results, step_times, decode_time = results[shortlist_size]
+        name = 'vocab shortlist' if shortlist_size else 'full vocab'
+        report_step_times(name, step_times, decode_time)
+
+        if config.data_type != 'ifttt':
+            bleu, acc = evaluate_decode_results(dataset, decode_results, verbose=False)
+            logging.info('%s: accuracy %f, sentence level bleu %f', name, acc, bleu)
+
+    report_saving('vocab shortlist', results[0][1], results[vocab_shortlist_size][1])
+
+    if config.data_type == 'ifttt':
+        logging.info('examples with the same top candidate: %d/%d',
+                     same_top_cand_num(results[0][0], results[vocab_shortlist_size][0]), dataset.count)
+
+
+def benchmark_greedy(model, dataset):
+    """
+    compare greedy decoding with beam search of `config.beam_size`, in both speed and accuracy
+    """
+    from decoder import decode_python_dataset, decode_ifttt_dataset
+    from evaluation import evaluate_decode_results, evaluate_ifttt_results
+
+    logging.info('benchmark greedy decoding against beam search of size %d on [%s] set, num. examples: %d',
+                 config.beam_size, dataset.name, dataset.count)
+
+    results = dict()
+    for beam_size in [config.beam_size, 1]:
+        if config.data_type == 'ifttt':
+            results[beam_size] = time_decoder_steps(model, decode_ifttt_dataset, model, dataset, False, beam_size)
+        else:
+            results[beam_size] = time_decoder_steps(model, decode_python_dataset, model, dataset, False, beam_size)
+
+    for beam_size in [config.beam_size, 1]:
+        decode_results, step_times, decode_time = results[beam_size]
+        name = 'greedy decoding' if beam_size == 1 else 'beam search'
+        report_step_times(name, step_times, decode_time)
+
+        if config.data_type == 'ifttt':
+            channel_acc, channel_func_acc, prod_f1 = evaluate_ifttt_results(dataset, decode_results, verbose=False)
+            logging.info('%s: channel+func accuracy %f, prod F1 %f', name, channel_func_acc, prod_f1)
+        else:
+            bleu, acc = evaluate_decode_results(dataset, decode_results, verbose=False)
+            logging.info('%s: accuracy %f, sentence level bleu %f', name, acc, bleu)
+
+    beam_decode_time = results[config.beam_size][2]
+    greedy_decode_time = results[1][2]
+    logging.info('greedy decoding speedup: %.1fx', beam_decode_time / max(greedy_decode_time, 1e-6))
@@ -0,0 +1,88 @@
+import os
+import logging
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+import config
+from nn.utils.io_utils import serialize_to_file, deserialize_from_file, save_npy_dir
+
+# the config values that define the model, stored in the bundle
+BUNDLE_CONFIG_NAMES = ['data_type', 'source_vocab_size', 'target_vocab_size', 'rule_num', 'node_num',
+                       'word_embed_dim', 'rule_embed_dim', 'node_embed_dim', 'encoder_hidden_dim',
+                       'decoder_hidden_dim', 'attention_hidden_dim', 'ptrnet_hidden_dim', 'dropout',
+                       'encoder', 'parent_hidden_state_feed', 'parent_action_feed', 'frontier_node_type_feed',
+                       'tree_attention', 'enable_copy', 'max_query_length']
+
+# the weights are uncompressed .npy files memory-mapped when loaded
+BUNDLE_WEIGHTS_DIR = 'weights'
+BUNDLE_META_FILE = 'meta.bin'
+
+InferenceBundle = namedtuple('InferenceBundle', ['model', 'grammar', 'annot_vocab', 'terminal_vocab'])
+
+
+def compact_grammar(grammar):
+    """
+    the grammar class, the rules ordered by rule id and the node type ids, all that
+    is needed to rebuild the grammar with the same ids
+    """
+    rules = [grammar.id_to_rule[rule_id] for rule_id in xrange(len(grammar))]
+
+    return {'class': grammar.__class__,
+            'rules': rules,
+            'node_type_to_id': OrderedDict(grammar.node_type_to_id)}
+
+
+def restore_grammar(grammar_info):
+    grammar = grammar_info['class'](grammar_info['rules'])
+
+    # the rule ids follow the order of the rules, but the node type ids do not
+    # come in a fixed order, so use the ids the model is trained with
+    grammar.node_type_to_id = grammar_info['node_type_to_id']
+
+    return grammar
+
+
+def export_bundle(bundle_dir, model_file, train_data):
+    """
+    export the weights in `model_file` with the grammar and vocabs of `train_data`
+    and the model config into `bundle_dir`, which is all that is needed for decoding
+    """
+    logging.info('export inference bundle to [%s]', bundle_dir)
+
+    if not os.path.exists(bundle_dir):
+        os.makedirs(bundle_dir)
+
+    weights = np.load(model_file)
+    save_npy_dir(dict((name, weights[name]) for name in weights.files), os.path.join(bundle_dir, BUNDLE_WEIGHTS_DIR))
+
+    meta = {'config': dict((name, getattr(config, name)) for name in BUNDLE_CONFIG_NAMES),
+            'grammar': compact_grammar(train_data.grammar),
+            'annot_vocab': train_data.annot_vocab,
+            'terminal_vocab': train_data.terminal_vocab,
+            'terminal_token_freq': train_data.get_terminal_token_freq()}
+
+    serialize_to_file(meta, os.path.join(bundle_dir, BUNDLE_META_FILE))
+
+
+def load_bundle(bundle_dir):
+    """
+    load an inference bundle exported by `export_bundle`, which sets the model config,
+    and build a model for decoding with its weights. return an `InferenceBundle`
+    """
+    from model import Model
+
+    logging.info('load inference bundle from [%s]', bundle_dir)
+    meta = deserialize_from_file(os.path.join(bundle_dir, BUNDLE_META_FILE))
+
+    for name, value in meta['config'].iteritems():
+        setattr(config, name, value)
+
+    grammar = restore_grammar(meta['grammar'])
+
+    model = Model()
+    model.build_inference()
+    model.load(os.path.join(bundle_dir, BUNDLE_WEIGHTS_DIR), mmap_mode='r')
+    model.terminal_token_freq = meta['terminal_token_freq']
+
+    return InferenceBundle(model, grammar, meta['annot_vocab'], meta['terminal_vocab'])
@@ -4,6 +4,7 @@ import ast
 import traceback
 import argparse
 import os
+import time
 import logging
 from vprof import profiler
 
@@ -13,7 +14,7 @@ import config
 from learner import Learner
 from evaluation import *
 from decoder import decode_python_dataset
-from components import Hyp
+from components import Hyp, DecodeBudget
 from astnode import ASTNode
 
 from nn.utils.generic_utils import init_logging
@@ -24,6 +25,8 @@ parser.add_argument('-data')
 parser.add_argument('-random_seed', default=181783, type=int)
 parser.add_argument('-output_dir', default='.outputs')
 parser.add_argument('-model', default=None)
+# the directory to cache the compiled Theano functions across runs, disabled if not set
+parser.add_argument('-func_cache_dir', default=None)
 
 # model's main configuration
 parser.add_argument('-data_type', default='django', choices=['django', 'ifttt', 'hs'])
@@ -76,20 +79,53 @@ parser.add_argument('-batch_size', default=10, type=int)
 parser.add_argument('-valid_per_batch', default=4000, type=int)
 parser.add_argument('-save_per_batch', default=4000, type=int)
 parser.add_argument('-valid_metric', default='bleu')
+# validate with greedy decoding instead of beam search
+parser.add_argument('-valid_greedy', action='store_true')
 
 # decoding
 parser.add_argument('-beam_size', default=15, type=int)
 parser.add_argument('-max_query_length', default=70, type=int)
 parser.add_argument('-decode_max_time_step', default=100, type=int)
+parser.add_argument('-decode_batch_size', default=10, type=int)
 parser.add_argument('-head_nt_constraint', dest='head_nt_constraint', action='store_true')
 parser.add_argument('-no_head_nt_constraint', dest='head_nt_constraint', action='store_false')
 parser.set_defaults(head_nt_constraint=True)
 
+# only score the legal rules of the frontier node when decoding, normalized over these rules
+parser.add_argument('-restricted_rule_softmax', dest='restricted_rule_softmax', action='store_true')
+parser.add_argument('-no_restricted_rule_softmax', dest='restricted_rule_softmax', action='store_false')
+parser.set_defaults(restricted_rule_softmax=False)
+
+# only generate the tokens allowed by the type of value nodes, e.g. numbers for int values
+parser.add_argument('-value_token_type_mask', dest='value_token_type_mask', action='store_true')
+parser.add_argument('-no_value_token_type_mask', dest='value_token_type_mask', action='store_false')
+parser.set_defaults(value_token_type_mask=True)
+
+# the number of most frequent terminals in the vocab shortlist of the token head when decoding, 0 to disable
+parser.add_argument('-vocab_shortlist_size', default=0, type=int)
+
+# stop the beam search once the best completed candidate scores no lower than the live ones.
+# keeps the top candidate but may drop lower ones, which the evaluation falls back on when
+# the top one does not convert to code, so it is off by default, validation included
+parser.add_argument('-early_stop', dest='early_stop', action='store_true')
+parser.add_argument('-no_early_stop', dest='early_stop', action='store_false')
+parser.set_defaults(early_stop=False)
+
+# drop the live hypotheses whose log probability is lower than the best candidate by more than this, 0 to disable
+parser.add_argument('-beam_prune_threshold', default=0., type=float)
+
+# the time limit in seconds and the max number of hypothesis expansions of decoding a query
+# in interactive mode, 0 for no limit. the candidates completed so far are returned when hit
+parser.add_argument('-decode_timeout', default=0., type=float)
+parser.add_argument('-decode_max_expansion_num', default=0, type=int)
+
 sub_parsers = parser.add_subparsers(dest='operation', help='operation to take')
 train_parser = sub_parsers.add_parser('train')
 decode_parser = sub_parsers.add_parser('decode')
 interactive_parser = sub_parsers.add_parser('interactive')
 evaluate_parser = sub_parsers.add_parser('evaluate')
+benchmark_parser = sub_parsers.add_parser('benchmark')
+export_bundle_parser = sub_parsers.add_parser('export_bundle')
 
 # decoding operation
 decode_parser.add_argument('-saveto', default='decode_results.bin')
@@ -106,6 +142,14 @@ evaluate_parser.add_argument('-seq2seq_decode_file')
 evaluate_parser.add_argument('-seq2seq_ref_file')
 evaluate_parser.add_argument('-is_nbest', default=False, action='store_true')
 
+# benchmark operation
+benchmark_parser.add_argument('-mode', default='rule_softmax', choices=['rule_softmax', 'vocab_shortlist', 'greedy'])
+benchmark_parser.add_argument('-type', default='test_data')
+benchmark_parser.add_argument('-example_num', default=100, type=int)
+
+# export the weights of -model with the grammar, vocabs and model config as an inference bundle
+export_bundle_parser.add_argument('-output', default='bundle')
+
 # misc
 parser.add_argument('-ifttt_test_split', default='data/ifff.test_data.gold.id')
 
@@ -134,6 +178,12 @@ if __name__ == '__main__':
     if not args.node_num:
         args.node_num = len(train_data.grammar.node_type_to_id)
 
+    # the restricted rule softmax or the vocab shortlist is compiled for comparison
+    if args.operation == 'benchmark' and args.mode == 'rule_softmax':
+        args.restricted_rule_softmax = True
+    if args.operation == 'benchmark' and args.mode == 'vocab_shortlist' and not args.vocab_shortlist_size:
+        args.vocab_shortlist_size = 500
+
     logging.info('current config: %s', args)
     config_module = sys.modules['config']
     for name, value in vars(args).iteritems():
@@ -149,12 +199,22 @@ if __name__ == '__main__':
     logging.info('source vocab size: %d', train_data.annot_vocab.size)
     logging.info('target vocab size: %d', train_data.terminal_vocab.size)
 
-    if args.operation in ['train', 'decode', 'interactive']:
+    if args.operation in ['train', 'decode', 'interactive', 'benchmark']:
         model = Model()
-        model.build()
+
+        # only training needs the training function, the others just decode
+        begin_time = time.time()
+        if args.operation == 'train':
+            model.build()
+        else:
+            model.build_inference()
+        logging.info('model built in %.2fs', time.time() - begin_time)
 
         if args.model:
-            model.load(args.model)
+            # only decoding processes can use read-only memory-mapped weights
+            model.load(args.model, mmap_mode=None if args.operation == 'train' else 'r')
+
+        model.terminal_token_freq = train_data.get_terminal_token_freq()
 
     if args.operation == 'train':
         # train_data = train_data.get_dataset_by_ids(range(2000), 'train_sample')
@@ -231,8 +291,15 @@ if __name__ == '__main__':
                 print 'gold parse tree:'
                 print example.parse_tree
 
+            budget = DecodeBudget(timeout=args.decode_timeout or None,
+                                  max_expansion_num=args.decode_max_expansion_num or None)
             cand_list = model.decode(example, train_data.grammar, train_data.terminal_vocab,
-                                     beam_size=args.beam_size, max_time_step=args.decode_max_time_step, log=True)
+                                     beam_size=args.beam_size, max_time_step=args.decode_max_time_step, log=True,
+                                     budget=budget)
+
+            print 'decoding budget: ', budget
+            if budget.timed_out:
+                print 'decoding is cut short by the %s, %d candidates completed' % (budget.status, len(cand_list))
 
             has_grammar_error = any([c for c in cand_list if c.has_grammar_error])
             print 'has_grammar_error: ', has_grammar_error
@@ -258,3 +325,23 @@ if __name__ == '__main__':
                     print 'n_timestep: %d' % cand.n_timestep
                     print 'ast size: %d' % cand.tree.size
                     print '*' * 60
+
+    if args.operation == 'benchmark':
+        dataset = eval(args.type)
+        dataset = dataset.get_dataset_by_ids(range(min(args.example_num, dataset.count)), dataset.name + '_sample')
+
+        if config.mode == 'rule_softmax':
+            from benchmark import benchmark_rule_softmax
+            benchmark_rule_softmax(model, dataset)
+        elif config.mode == 'vocab_shortlist':
+            from benchmark import benchmark_vocab_shortlist
+            benchmark_vocab_shortlist(model, dataset)
+        elif config.mode == 'greedy':
+            from benchmark import benchmark_greedy
+            benchmark_greedy(model, dataset)
+
+    if args.operation == 'export_bundle':
+        from bundle import export_bundle
+        assert args.model, 'export_bundle needs the weights of a trained model in -model'
+
+        export_bundle(args.output, args.model, train_data)
@@ -3,6 +3,8 @@ import theano.tensor as T
 import numpy as np
 import logging
 import copy
+import time
+from collections import namedtuple
 
 from nn.layers.embeddings import Embedding
 from nn.layers.core import Dense, Layer
@@ -32,8 +34,10 @@ class PointerNet(Layer):
 
         self.set_name(name)
 
-    def __call__(self, query_embed, query_token_embed_mask, decoder_states):
-        query_embed_trans = self.dense1_input(query_embed)
+    def __call__(self, query_embed, query_token_embed_mask, decoder_states, query_embed_trans=None):
+        # `query_embed_trans` only depends on the query, and can be precomputed for decoding
+        if query_embed_trans is None:
+            query_embed_trans = self.dense1_input(query_embed)
         h_trans = self.dense1_h(decoder_states)
 
         query_embed_trans = query_embed_trans.dimshuffle((0, 'x', 1, 2))
@@ -50,34 +54,52 @@ class PointerNet(Layer):
 
         return scores
 
+# a pending frontier node of a hypothesis. `parent_rule_id`, `parent_t` and `parent_h` are
+# the id, the time step and the decoder hidden state of the rule application that created it,
+# `value` is the partial value of a value node
+FrontierNode = namedtuple('FrontierNode', ['type', 'label', 'type_id', 'is_value',
+                                           'parent_rule_id', 'parent_t', 'parent_h', 'value'])
+
+
 class Hyp:
     def __init__(self, *args):
         if isinstance(args[0], Hyp):
             hyp = args[0]
             self.grammar = hyp.grammar
-            self.tree = hyp.tree.copy()
             self.t = hyp.t
-            self.hist_h = list(hyp.hist_h)
+            self.frontier_stack = list(hyp.frontier_stack)
             self.log = hyp.log
             self.has_grammar_error = hyp.has_grammar_error
         else:
             assert isinstance(args[0], Grammar)
             grammar = args[0]
             self.grammar = grammar
-            self.tree = DecodeTree(grammar.root_node.type)
             self.t=-1
-            self.hist_h = []
+            # the pending frontier nodes in right-to-left order, the current one is on the top
+            root_node = grammar.root_node
+            self.frontier_stack = [FrontierNode(root_node.type, root_node.label, grammar.get_node_type_id(root_node.type),
+                                                grammar.is_value_node(root_node), -1, 0, None, None)]
             self.log = ''
             self.has_grammar_error = False
 
         self.score = 0.0
 
-        self.__frontier_nt = self.tree
-        self.__frontier_nt_t = -1
+        # the sequence of applied rules and generated tokens, which is only
+        # recovered from the beam lattice for finished hypotheses. the decode
+        # tree is built from it on demand
+        self.actions = None
+        self._tree = None
 
     def __repr__(self):
         return self.tree.__repr__()
 
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = self.build_tree()
+
+        return self._tree
+
     def can_expand(self, node):
         if self.grammar.is_value_node(node):
             # if the node is finished
@@ -101,64 +123,51 @@ class Hyp:
 
         return True
 
-    def apply_rule(self, rule, nt=None):
-        if nt is None:
-            nt = self.frontier_nt()
+    def apply_rule(self, rule, rule_id=None, parent_h=None):
+        if rule_id is None:
+            rule_id = self.grammar.rule_to_id[rule]
+
+        nt = self.frontier_stack.pop()
 
         # assert rule.parent.type == nt.type
-        if rule.parent.type != nt.type:
+        if rule.type != nt.type:
             self.has_grammar_error = True
 
         self.t += 1
-        # set the time step when the rule leading by this nt is applied
-        nt.t = self.t
-        # record the ApplyRule action that is used to expand the current node
-        nt.applied_rule = rule
 
-        for child_node in rule.children:
-            child = DecodeTree(child_node.type, child_node.label, child_node.value)
-            # if is_builtin_type(rule.parent.type):
-            #     child.label = None
-            #     child.holds_value = True
+        # the expandable child nodes become the new frontier nodes, leftmost on the top
+        child_type_ids = self.grammar.rule_child_type_ids[rule_id]
+        child_is_value = self.grammar.rule_child_is_value[rule_id]
+        for i in reversed(self.grammar.rule_frontier_child_ids[rule_id]):
+            child = rule.children[i]
+            self.frontier_stack.append(FrontierNode(child.type, child.label, child_type_ids[i], child_is_value[i],
+                                                    rule_id, self.t, parent_h, None))
 
-            nt.add_child(child)
-
-    def append_token(self, token, nt=None):
-        if nt is None:
-            nt = self.frontier_nt()
+    def append_token(self, token):
+        nt = self.frontier_stack[-1]
 
         self.t += 1
 
-        if nt.value is None:
-            # this terminal node is empty
-            nt.t = self.t
-            nt.value = token
-        else:
-            nt.value += token
+        value = token if nt.value is None else nt.value + token
 
-    def frontier_nt_helper(self, node):
-        if node.is_leaf:
-            if self.can_expand(node):
-                return node
-            else:
-                return None
+        # the value node is finished
+        if value.endswith('<eos>'):
+            self.frontier_stack.pop()
+        else:
+            self.frontier_stack[-1] = nt._replace(value=value)
 
-        for child in node.children:
-            result = self.frontier_nt_helper(child)
-            if result:
-                return result
+    def frontier_nt(self):
+        if self.frontier_stack:
+            return self.frontier_stack[-1]
 
         return None
 
-    def frontier_nt(self):
-        if self.__frontier_nt_t == self.t:
-            return self.__frontier_nt
-        else:
-            _frontier_nt = self.frontier_nt_helper(self.tree)
-            self.__frontier_nt = _frontier_nt
-            self.__frontier_nt_t = self.t
+    def frontier_nt_repr(self):
+        nt = self.frontier_nt()
+        if nt is None:
+            return str(None)
 
-            return _frontier_nt
+        return DecodeTree(nt.type, nt.label, nt.value).__repr__()
 
     def get_action_parent_t(self):
         """
@@ -166,31 +175,306 @@ class Hyp:
         action was generated
         WARNING: 0 will be returned if parent if None
         """
-        nt = self.frontier_nt()
+        return self.frontier_stack[-1].parent_t
+
+    def build_tree(self):
+        """
+        replay the actions to build the decode tree
+        """
+        tree = DecodeTree(self.grammar.root_node.type)
+        frontier_stack = [tree]
+
+        for t, action in enumerate(self.actions):
+            nt = frontier_stack[-1]
 
-        # if nt is a non-finishing leaf
-        # if nt.holds_value:
-        #     return nt.t
+            if isinstance(action, Rule):
+                frontier_stack.pop()
 
-        if nt.parent:
-            return nt.parent.t
+                # set the time step when the rule leading by this nt is applied
+                nt.t = t
+                # record the ApplyRule action that is used to expand the current node
+                nt.applied_rule = action
+
+                children = []
+                for child_node in action.children:
+                    child = DecodeTree(child_node.type, child_node.label, child_node.value)
+                    nt.add_child(child)
+                    children.append(child)
+
+                for child in reversed(children):
+                    if self.can_expand(child):
+                        frontier_stack.append(child)
+            else:
+                if nt.value is None:
+                    # this terminal node is empty
+                    nt.t = t
+                    nt.value = action
+                else:
+                    nt.value += action
+
+                if not self.can_expand(nt):
+                    frontier_stack.pop()
+
+        return tree
+
+
+class BeamState:
+    """
+    the decoder inputs of the live hypotheses of one example, stored as preallocated
+    arrays of `beam_size` rows, of which the first `hyp_num` rows are in use.
+    the rows follow the order of the live hypotheses
+    """
+    def __init__(self, beam_size):
+        self.hyp_num = 0
+
+        self.state = np.zeros((beam_size, config.decoder_hidden_dim), dtype='float32')
+        self.cell = np.zeros((beam_size, config.decoder_hidden_dim), dtype='float32')
+        self.action_embed = np.zeros((beam_size, config.rule_embed_dim), dtype='float32')
+        self.node_id = np.zeros(beam_size, dtype='int32')
+        self.parent_rule_id = np.zeros(beam_size, dtype='int32')
+        # whether the frontier node is a value node
+        self.is_value = np.zeros(beam_size, dtype='bool')
+        self.parent_t = np.zeros(beam_size, dtype='int32')
+        # the hidden state of the parent action, used without tree attention
+        self.parent_h = np.zeros((beam_size, config.decoder_hidden_dim), dtype='float32')
+        self.score = np.zeros(beam_size, dtype='float32')
+
+        # with tree attention, the history of hidden states and their
+        # projections, (hyp_num, t, dim)
+        self.hist_h = None
+        self.hist_h_att_trans = None
+
+    def __len__(self):
+        return self.hyp_num
+
+    def update(self, parent_ids, scores, next_state, next_cell, next_hist_h_att_trans=None):
+        """
+        reorder the decoder states by the ids of the parents of the new live hypotheses
+        in the step outputs, and set their scores. the inputs depending on the frontier
+        nodes and the actions are set by the caller
+        """
+        hyp_num = len(parent_ids)
+
+        np.take(next_state, parent_ids, axis=0, out=self.state[:hyp_num])
+        np.take(next_cell, parent_ids, axis=0, out=self.cell[:hyp_num])
+        self.score[:hyp_num] = scores
+
+        # extend the history of hidden states
+        if next_hist_h_att_trans is not None:
+            new_hist_h = next_state[parent_ids, None, :]
+            new_hist_h_att_trans = next_hist_h_att_trans[parent_ids, None, :]
+            if self.hist_h is not None:
+                new_hist_h = np.concatenate([self.hist_h[parent_ids], new_hist_h], axis=1)
+                new_hist_h_att_trans = np.concatenate([self.hist_h_att_trans[parent_ids], new_hist_h_att_trans], axis=1)
+
+            self.hist_h = new_hist_h
+            self.hist_h_att_trans = new_hist_h_att_trans
+
+        self.hyp_num = hyp_num
+
+    def set_frontier(self, i, frontier_nt):
+        self.node_id[i] = frontier_nt.type_id
+        self.is_value[i] = frontier_nt.is_value
+        self.parent_rule_id[i] = frontier_nt.parent_rule_id
+        self.parent_t[i] = frontier_nt.parent_t
+        if frontier_nt.parent_h is not None:
+            self.parent_h[i] = frontier_nt.parent_h
         else:
-            return 0
-
-    # def get_action_parent_tree(self):
-    #     """
-    #     get the parent tree
-    #     """
-    #     nt = self.frontier_nt()
-    #
-    #     # if nt is a non-finishing leaf
-    #     if nt.holds_value:
-    #         return nt
-    #
-    #     if nt.parent:
-    #         return nt.parent
-    #     else:
-    #         return None
+            self.parent_h[i] = 0.
+
+
+class DecodeJob:
+    """
+    the beam search state of one example when decoding a batch of examples
+    """
+    def __init__(self, example, grammar, terminal_vocab, beam_size):
+        self.example = example
+        self.grammar = grammar
+
+        unk = terminal_vocab.unk
+
+        # source word id in the terminal vocab
+        self.src_token_id = [terminal_vocab[t] for t in example.query][:config.max_query_length]
+        self.unk_pos_list = [x for x, t in enumerate(self.src_token_id) if t == unk]
+
+        # sometimes a word may appear multi-times in the source, in this case,
+        # we just copy its first appearing position. Therefore we mask the words
+        # appearing second and onwards to -1
+        token_set = set()
+        for i, tid in enumerate(self.src_token_id):
+            if tid in token_set:
+                self.src_token_id[i] = -1
+            else: token_set.add(tid)
+
+        # the source positions that can be copied and their ids in the terminal vocab,
+        # used to scatter the copy probabilities into the terminal vocab
+        self.copy_src_pos = np.array([i for i, tid in enumerate(self.src_token_id) if tid != -1], dtype='int32')
+        self.copy_token_id = np.array(self.src_token_id, dtype='int32')[self.copy_src_pos]
+        self.unk_pos = np.array(self.unk_pos_list, dtype='int32')
+
+        root_hyp = Hyp(grammar)
+        root_hyp.lattice_id = -1
+
+        # the frontiers of the live hypotheses, and their decoder inputs
+        self.hyp_samples = [root_hyp]
+        self.beam = BeamState(beam_size)
+        self.beam.set_frontier(0, root_hyp.frontier_nt())
+        self.beam.hyp_num = 1
+        self.completed_hyps = []
+        self.completed_hyp_num = 0
+        self.finished = False
+
+        # the beam lattice. For each time step, it stores the hypotheses expanded at
+        # that step: the lattice id of the hypothesis they are expanded from at the
+        # previous step, the applied rule id (-1 for tokens), the generated token,
+        # the score, and the copy probability of the token for decode logs
+        self.lattice = []
+
+    def add_lattice_step(self, backpointers, rule_ids, tokens, scores, copy_probs):
+        self.lattice.append((np.array(backpointers, dtype='int32'), np.array(rule_ids, dtype='int32'),
+                             tokens, np.array(scores), np.array(copy_probs)))
+
+    def get_hyp(self, t, lattice_id, log=False):
+        """
+        recover the finished hypothesis with `lattice_id` at time step `t` from the lattice
+        """
+        actions = []
+        copy_probs = []
+        for s in xrange(t, -1, -1):
+            backpointers, rule_ids, tokens, scores, step_copy_probs = self.lattice[s]
+            if rule_ids[lattice_id] >= 0:
+                actions.append(self.grammar.id_to_rule[rule_ids[lattice_id]])
+            else:
+                actions.append(tokens[lattice_id])
+            copy_probs.append(step_copy_probs[lattice_id])
+
+            if s == t:
+                score = scores[lattice_id]
+
+            lattice_id = backpointers[lattice_id]
+
+        actions.reverse()
+        copy_probs.reverse()
+
+        hyp = Hyp(self.grammar)
+        for action, cand_copy_prob in zip(actions, copy_probs):
+            if isinstance(action, Rule):
+                hyp.apply_rule(action)
+            else:
+                hyp.append_token(action)
+
+                if log and cand_copy_prob > 0.5:
+                    hyp.log += ' || ' + hyp.frontier_nt_repr() + '{copy[%s][p=%f]}' % (action, cand_copy_prob)
+
+        hyp.actions = actions
+        hyp.score = score
+        hyp.n_timestep = t + 1
+
+        return hyp
+
+
+# an event of streaming decoding of the example `example_id`. 'completed': the hypothesis
+# `hyp` with `score` is completed at time step `step`. 'finished': the search ends at time
+# step `step`, `cand_list` is the sorted completed hypotheses and `hyp` is the top one or None
+DecodeEvent = namedtuple('DecodeEvent', ['kind', 'example_id', 'hyp', 'score', 'step', 'cand_list'])
+
+
+class DecodeBudget:
+    """
+    the wall-clock deadline (seconds since the epoch, or `timeout` seconds from now)
+    and the maximum number of hypothesis expansions allowed to decode one example,
+    None for no limit. The deadline is checked before each decoder step, and a step
+    is only taken if all its expansions fit in the budget. Decoding records how much
+    of the budget is used, and why the search ended in `status`: 'finished' if the
+    search ended by itself or at the max time step, 'deadline' or 'expansion_budget' if it is
+    cut short, and 'cancelled' if streaming decoding is closed before it ends or `cancel` is called
+    """
+    def __init__(self, deadline=None, max_expansion_num=None, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout if deadline is None else min(deadline, time.time() + timeout)
+
+        self.deadline = deadline
+        self.max_expansion_num = max_expansion_num
+
+        self.begin_time = None
+        self.end_time = None
+        self.expansion_num = 0
+        self.step_num = 0
+        self.status = None
+        self.cancelled = False
+
+    def start(self):
+        self.begin_time = time.time()
+        self.end_time = None
+        self.expansion_num = 0
+        self.step_num = 0
+        self.status = None
+
+    def spend(self, expansion_num):
+        """
+        take a decoder step with `expansion_num` hypothesis expansions if it fits in
+        the budget, otherwise return the status of the exhausted budget
+        """
+        if self.cancelled:
+            return 'cancelled'
+
+        if self.deadline is not None and time.time() >= self.deadline:
+            return 'deadline'
+
+        if self.max_expansion_num is not None and self.expansion_num + expansion_num > self.max_expansion_num:
+            return 'expansion_budget'
+
+        self.expansion_num += expansion_num
+        self.step_num += 1
+
+        return None
+
+    def cancel(self):
+        """
+        stop decoding before the next decoder step, may be called from another thread
+        """
+        self.cancelled = True
+
+    def finish(self, status):
+        if self.status is None:
+            self.status = status
+            self.end_time = time.time()
+
+    @property
+    def timed_out(self):
+        return self.status in ['deadline', 'expansion_budget']
+
+    @property
+    def time_used(self):
+        if self.begin_time is None:
+            return 0.
+
+        return (self.end_time or time.time()) - self.begin_time
+
+    def report(self):
+        """
+        how much of the budget is used, the used fraction of each limit is None if unlimited
+        """
+        time_used_ratio = None
+        if self.deadline is not None and self.begin_time is not None:
+            time_used_ratio = self.time_used / max(self.deadline - self.begin_time, 1e-6)
+
+        expansion_used_ratio = None
+        if self.max_expansion_num is not None:
+            expansion_used_ratio = self.expansion_num / float(max(self.max_expansion_num, 1))
+
+        return {'status': self.status,
+                'timed_out': self.timed_out,
+                'time_used': self.time_used,
+                'time_used_ratio': time_used_ratio,
+                'expansion_num': self.expansion_num,
+                'expansion_used_ratio': expansion_used_ratio,
+                'step_num': self.step_num}
+
+    def __repr__(self):
+        return 'DecodeBudget(status=%s, time used: %.3fs, expansions: %d/%s, steps: %d)' % \
+               (self.status, self.time_used, self.expansion_num, self.max_expansion_num, self.step_num)
+
 
 class CondAttLSTM(Layer):
     """
@@ -290,26 +574,9 @@ class CondAttLSTM(Layer):
 
         # context: (batch_size, context_size, context_dim)
 
-        # (batch_size, att_layer1_dim)
-        h_tm1_att_trans = T.dot(h_tm1, att_h_w1)
-
-        # h_tm1_att_trans = theano.printing.Print('h_tm1_att_trans')(h_tm1_att_trans)
-
-        # (batch_size, context_size, att_layer1_dim)
-        att_hidden = T.tanh(context_att_trans + h_tm1_att_trans[:, None, :])
-        # (batch_size, context_size, 1)
-        att_raw = T.dot(att_hidden, att_w2) + att_b2
-        att_raw = att_raw.reshape((att_raw.shape[0], att_raw.shape[1]))
-
-        # (batch_size, context_size)
-        ctx_att = T.exp(att_raw - T.max(att_raw, axis=-1, keepdims=True))
-
-        if context_mask:
-            ctx_att = ctx_att * context_mask
-
-        ctx_att = ctx_att / T.sum(ctx_att, axis=-1, keepdims=True)
         # (batch_size, context_dim)
-        ctx_vec = T.sum(context * ctx_att[:, :, None], axis=1)
+        ctx_vec = self._attention_over_context(h_tm1, att_h_w1, att_w2, att_b2,
+                                               context, context_mask, context_att_trans)
 
         # t = theano.printing.Print('t')(t)
 
@@ -319,23 +586,9 @@ class CondAttLSTM(Layer):
             hist_h_mask = T.zeros((hist_h.shape[0], hist_h.shape[1]), dtype='int8')
             hist_h_mask = T.set_subtensor(hist_h_mask[:, T.arange(t)], 1)
 
-            hist_h_att_trans = T.dot(hist_h, self.hatt_hist_W1) + self.hatt_b1
-            h_tm1_hatt_trans = T.dot(h_tm1, self.hatt_h_W1)
+            hist_h_att_trans = self.get_hist_h_att_trans(hist_h)
 
-            hatt_hidden = T.tanh(hist_h_att_trans + h_tm1_hatt_trans[:, None, :])
-            hatt_raw = T.dot(hatt_hidden, self.hatt_W2) + self.hatt_b2
-            hatt_raw = hatt_raw.reshape((hist_h.shape[0], hist_h.shape[1]))
-            # hatt_raw = theano.printing.Print('hatt_raw')(hatt_raw)
-            hatt_exp = T.exp(hatt_raw - T.max(hatt_raw, axis=-1, keepdims=True)) * hist_h_mask
-            # hatt_exp = theano.printing.Print('hatt_exp')(hatt_exp)
-            # hatt_exp = hatt_exp.flatten(2)
-            h_att_weights = hatt_exp / (T.sum(hatt_exp, axis=-1, keepdims=True) + 1e-7)
-            # h_att_weights = theano.printing.Print('h_att_weights')(h_att_weights)
-
-            # (batch_size, output_dim)
-            _h_ctx_vec = T.sum(hist_h * h_att_weights[:, :, None], axis=1)
-
-            return _h_ctx_vec
+            return self._attention_over_history(h_tm1, hist_h, hist_h_att_trans, hist_h_mask)
 
         h_ctx_vec = T.switch(t,
                              _attention_over_history(),
@@ -355,7 +608,152 @@ class CondAttLSTM(Layer):
                          T.zeros_like(h_tm1))
 
         ##### feed in parent hidden state #####
+        h_t, c_t = self._lstm_gates(xi_t, xf_t, xo_t, xc_t, h_tm1, c_tm1,
+                                    ctx_vec, par_h, h_ctx_vec,
+                                    (u_i, u_f, u_o, u_c), (c_i, c_f, c_o, c_c),
+                                    (h_i, h_f, h_o, h_c), (p_i, p_f, p_o, p_c),
+                                    b_u)
+
+        h_t = (1 - mask_t) * h_tm1 + mask_t * h_t
+        c_t = (1 - mask_t) * c_tm1 + mask_t * c_t
+
+        new_hist_h = T.set_subtensor(hist_h[:, t, :], h_t)
+
+        return h_t, c_t, ctx_vec, new_hist_h
+
+    def _cached_history_step(self,
+                             t, xi_t, xf_t, xo_t, xc_t, mask_t, parent_t,
+                             h_tm1, c_tm1,
+                             u_i, u_f, u_o, u_c,
+                             c_i, c_f, c_o, c_c,
+                             h_i, h_f, h_o, h_c,
+                             p_i, p_f, p_o, p_c,
+                             att_h_w1, att_w2, att_b2,
+                             context, context_mask, context_att_trans,
+                             hist_h, hist_h_att_trans,
+                             b_u):
+        """
+        inference step with attention over history, where `hist_h` (batch_size, t, output_dim)
+        only holds the hidden states of the first t steps, and `hist_h_att_trans` holds their
+        cached projections by `get_hist_h_att_trans`
+        """
+
+        # (batch_size, context_dim)
+        ctx_vec = self._attention_over_context(h_tm1, att_h_w1, att_w2, att_b2,
+                                               context, context_mask, context_att_trans)
+
+        h_ctx_vec = T.switch(t,
+                             self._attention_over_history(h_tm1, hist_h, hist_h_att_trans),
+                             T.zeros_like(h_tm1))
+
+        if not config.parent_hidden_state_feed:
+            t = 0
+
+        par_h = T.switch(t,
+                         hist_h[T.arange(hist_h.shape[0]), parent_t, :],
+                         T.zeros_like(h_tm1))
+
+        h_t, c_t = self._lstm_gates(xi_t, xf_t, xo_t, xc_t, h_tm1, c_tm1,
+                                    ctx_vec, par_h, h_ctx_vec,
+                                    (u_i, u_f, u_o, u_c), (c_i, c_f, c_o, c_c),
+                                    (h_i, h_f, h_o, h_c), (p_i, p_f, p_o, p_c),
+                                    b_u)
+
+        h_t = (1 - mask_t) * h_tm1 + mask_t * h_t
+        c_t = (1 - mask_t) * c_tm1 + mask_t * c_t
+
+        return h_t, c_t, ctx_vec
+
+    def _parent_h_step(self,
+                       t, xi_t, xf_t, xo_t, xc_t, mask_t, par_h,
+                       h_tm1, c_tm1,
+                       u_i, u_f, u_o, u_c,
+                       c_i, c_f, c_o, c_c,
+                       p_i, p_f, p_o, p_c,
+                       att_h_w1, att_w2, att_b2,
+                       context, context_mask, context_att_trans,
+                       b_u):
+        """
+        inference step without attention over history, where the parent hidden state
+        `par_h` (batch_size, output_dim) is fed in directly instead of the full history
+        """
+
+        # (batch_size, context_dim)
+        ctx_vec = self._attention_over_context(h_tm1, att_h_w1, att_w2, att_b2,
+                                               context, context_mask, context_att_trans)
+
+        if not config.parent_hidden_state_feed:
+            t = 0
+
+        par_h = T.switch(t, par_h, T.zeros_like(h_tm1))
+
+        h_t, c_t = self._lstm_gates(xi_t, xf_t, xo_t, xc_t, h_tm1, c_tm1,
+                                    ctx_vec, par_h, None,
+                                    (u_i, u_f, u_o, u_c), (c_i, c_f, c_o, c_c),
+                                    None, (p_i, p_f, p_o, p_c),
+                                    b_u)
+
+        h_t = (1 - mask_t) * h_tm1 + mask_t * h_t
+        c_t = (1 - mask_t) * c_tm1 + mask_t * c_t
+
+        return h_t, c_t, ctx_vec
+
+    def _attention_over_context(self, h_tm1, att_h_w1, att_w2, att_b2,
+                                context, context_mask, context_att_trans):
+        # (batch_size, att_layer1_dim)
+        h_tm1_att_trans = T.dot(h_tm1, att_h_w1)
+
+        # h_tm1_att_trans = theano.printing.Print('h_tm1_att_trans')(h_tm1_att_trans)
+
+        # (batch_size, context_size, att_layer1_dim)
+        att_hidden = T.tanh(context_att_trans + h_tm1_att_trans[:, None, :])
+        # (batch_size, context_size, 1)
+        att_raw = T.dot(att_hidden, att_w2) + att_b2
+        att_raw = att_raw.reshape((att_raw.shape[0], att_raw.shape[1]))
+
+        # (batch_size, context_size)
+        ctx_att = T.exp(att_raw - T.max(att_raw, axis=-1, keepdims=True))
+
+        if context_mask:
+            ctx_att = ctx_att * context_mask
+
+        ctx_att = ctx_att / T.sum(ctx_att, axis=-1, keepdims=True)
+        # (batch_size, context_dim)
+        ctx_vec = T.sum(context * ctx_att[:, :, None], axis=1)
+
+        return ctx_vec
+
+    def _attention_over_history(self, h_tm1, hist_h, hist_h_att_trans, hist_h_mask=None):
+        h_tm1_hatt_trans = T.dot(h_tm1, self.hatt_h_W1)
+
+        hatt_hidden = T.tanh(hist_h_att_trans + h_tm1_hatt_trans[:, None, :])
+        hatt_raw = T.dot(hatt_hidden, self.hatt_W2) + self.hatt_b2
+        hatt_raw = hatt_raw.reshape((hist_h.shape[0], hist_h.shape[1]))
+        # hatt_raw = theano.printing.Print('hatt_raw')(hatt_raw)
+        hatt_exp = T.exp(hatt_raw - T.max(hatt_raw, axis=-1, keepdims=True))
+        if hist_h_mask is not None:
+            hatt_exp = hatt_exp * hist_h_mask
+        # hatt_exp = theano.printing.Print('hatt_exp')(hatt_exp)
+        # hatt_exp = hatt_exp.flatten(2)
+        h_att_weights = hatt_exp / (T.sum(hatt_exp, axis=-1, keepdims=True) + 1e-7)
+        # h_att_weights = theano.printing.Print('h_att_weights')(h_att_weights)
+
+        # (batch_size, output_dim)
+        h_ctx_vec = T.sum(hist_h * h_att_weights[:, :, None], axis=1)
+
+        return h_ctx_vec
+
+    def _lstm_gates(self, xi_t, xf_t, xo_t, xc_t, h_tm1, c_tm1,
+                    ctx_vec, par_h, h_ctx_vec,
+                    u, c, h, p,
+                    b_u):
+        u_i, u_f, u_o, u_c = u
+        c_i, c_f, c_o, c_c = c
+        p_i, p_f, p_o, p_c = p
+
         if config.tree_attention:
+            h_i, h_f, h_o, h_c = h
+
             i_t = self.inner_activation(
                 xi_t + T.dot(h_tm1 * b_u[0], u_i) + T.dot(ctx_vec, c_i) + T.dot(par_h, p_i) + T.dot(h_ctx_vec, h_i))
             f_t = self.inner_activation(
@@ -375,12 +773,7 @@ class CondAttLSTM(Layer):
                 xo_t + T.dot(h_tm1 * b_u[3], u_o) + T.dot(ctx_vec, c_o) + T.dot(par_h, p_o))  # + T.dot(h_ctx_vec, h_o)
         h_t = o_t * self.activation(c_t)
 
-        h_t = (1 - mask_t) * h_tm1 + mask_t * h_t
-        c_t = (1 - mask_t) * c_tm1 + mask_t * c_t
-
-        new_hist_h = T.set_subtensor(hist_h[:, t, :], h_t)
-
-        return h_t, c_t, ctx_vec, new_hist_h
+        return h_t, c_t
 
     def _for_step(self,
                   xi_t, xf_t, xo_t, xc_t, mask_t,
@@ -443,10 +836,16 @@ class CondAttLSTM(Layer):
 
         return h_t, c_t, ctx_vec
 
-    def __call__(self, X, context, parent_t_seq, init_state=None, init_cell=None, hist_h=None,
-                 mask=None, context_mask=None,
+    def __call__(self, X, context, parent_t_seq=None, init_state=None, init_cell=None, hist_h=None,
+                 mask=None, context_mask=None, context_att_trans=None, parent_h=None, hist_h_att_trans=None,
                  dropout=0, train=True, srng=None,
                  time_steps=None):
+        """
+        if `parent_h` (batch_size, output_dim) is given, run a single inference step
+        feeding in the parent hidden state directly. This requires `tree_attention` to be off.
+        if `hist_h_att_trans` is given, run a single inference step with attention over
+        the first t steps in `hist_h`, using the cached projections in `hist_h_att_trans`
+        """
         assert context_mask.dtype == 'int8', 'context_mask is not int8, got %s' % context_mask.dtype
 
         # (n_timestep, batch_size)
@@ -475,7 +874,8 @@ class CondAttLSTM(Layer):
         xo = T.dot(X * B_w[3], self.W_o) + self.b_o
 
         # (batch_size, context_size, att_layer1_dim)
-        context_att_trans = T.dot(context, self.att_ctx_W1) + self.att_b1
+        if context_att_trans is None:
+            context_att_trans = self.get_context_att_trans(context)
 
         if init_state:
             # (batch_size, output_dim)
@@ -489,6 +889,66 @@ class CondAttLSTM(Layer):
         else:
             first_cell = T.unbroadcast(alloc_zeros_matrix(X.shape[1], self.output_dim), 1)
 
+        if parent_h is not None:
+            assert not train and not config.tree_attention
+
+            # (n_timestep=1, batch_size, output_dim)
+            parent_h_seq = T.shape_padleft(parent_h)
+
+            [outputs, cells, ctx_vectors], updates = theano.scan(
+                self._parent_h_step,
+                sequences=[time_steps, xi, xf, xo, xc, mask, parent_h_seq],
+                outputs_info=[
+                    first_state,  # for h
+                    first_cell,  # for cell
+                    None,  # for ctx vector
+                ],
+                non_sequences=[
+                    self.U_i, self.U_f, self.U_o, self.U_c,
+                    self.C_i, self.C_f, self.C_o, self.C_c,
+                    self.P_i, self.P_f, self.P_o, self.P_c,
+                    self.att_h_W1, self.att_W2, self.att_b2,
+                    context, context_mask, context_att_trans,
+                    B_u
+                ])
+
+            outputs = outputs.dimshuffle((1, 0, 2))
+            ctx_vectors = ctx_vectors.dimshuffle((1, 0, 2))
+            cells = cells.dimshuffle((1, 0, 2))
+
+            return outputs, cells, ctx_vectors
+
+        if hist_h_att_trans is not None:
+            assert not train and config.tree_attention
+
+            # (n_timestep, batch_size)
+            parent_t_seq = parent_t_seq.dimshuffle((1, 0))
+
+            [outputs, cells, ctx_vectors], updates = theano.scan(
+                self._cached_history_step,
+                sequences=[time_steps, xi, xf, xo, xc, mask, parent_t_seq],
+                outputs_info=[
+                    first_state,  # for h
+                    first_cell,  # for cell
+                    None,  # for ctx vector
+                ],
+                non_sequences=[
+                    self.U_i, self.U_f, self.U_o, self.U_c,
+                    self.C_i, self.C_f, self.C_o, self.C_c,
+                    self.H_i, self.H_f, self.H_o, self.H_c,
+                    self.P_i, self.P_f, self.P_o, self.P_c,
+                    self.att_h_W1, self.att_W2, self.att_b2,
+                    context, context_mask, context_att_trans,
+                    hist_h, hist_h_att_trans,
+                    B_u
+                ])
+
+            outputs = outputs.dimshuffle((1, 0, 2))
+            ctx_vectors = ctx_vectors.dimshuffle((1, 0, 2))
+            cells = cells.dimshuffle((1, 0, 2))
+
+            return outputs, cells, ctx_vectors
+
         if not hist_h:
             # (batch_size, n_timestep, output_dim)
             hist_h = alloc_zeros_matrix(X.shape[1], X.shape[0], self.output_dim)
@@ -525,6 +985,19 @@ class CondAttLSTM(Layer):
 
         return outputs, cells, ctx_vectors
 
+    def get_context_att_trans(self, context):
+        """
+        the query-only term of the attention layer, which can be precomputed once per query for decoding
+        """
+        return T.dot(context, self.att_ctx_W1) + self.att_b1
+
+    def get_hist_h_att_trans(self, hist_h):
+        """
+        the projection of past hidden states used by attention over history.
+        A hidden state is projected only once when decoding, and the result is cached
+        """
+        return T.dot(hist_h, self.hatt_hist_W1) + self.hatt_b1
+
     def get_mask(self, mask, X):
         if mask is None:
             mask = T.ones((X.shape[0], X.shape[1]))
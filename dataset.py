@@ -214,6 +214,17 @@ class DataSet:
 
         return data
 
+    def get_terminal_token_freq(self):
+        """
+        the number of times each terminal token is generated in the dataset, (terminal_vocab_size)
+        """
+        tgt_action_seq = self.data_matrix['tgt_action_seq']
+        tgt_action_seq_type = self.data_matrix['tgt_action_seq_type']
+
+        gen_token_ids = tgt_action_seq[:, :, 1][tgt_action_seq_type[:, :, 1] > 0]
+
+        return np.bincount(gen_token_ids, minlength=self.terminal_vocab.size)
+
 
     def init_data_matrices(self, max_query_length=70, max_example_action_num=100):
         logging.info('init data matrices for [%s] dataset', self.name)
@@ -599,7 +610,7 @@ def check_terminals():
 
 def query_to_data(query, annot_vocab):
     query_tokens = query.split(' ')
-    token_num = min(config.max_qeury_length, len(query_tokens))
+    token_num = min(config.max_query_length, len(query_tokens))
     data = np.zeros((1, token_num), dtype='int32')
 
     for tid, token in enumerate(query_tokens[:token_num]):
@@ -661,6 +672,16 @@ def canonicalize_query(query):
     return query, str_map
 
 
+def decanonicalize_code(code, str_map):
+    """
+    put back the strings of the query replaced by `canonicalize_query` into the generated code
+    """
+    for str_literal, str_repr in str_map.iteritems():
+        code = code.replace('\'' + str_repr + '\'', str_literal)
+
+    return code
+
+
 def canonicalize_example(query, code):
     from lang.py.parse import parse_raw, parse_tree_to_python_ast, canonicalize_code as make_it_compilable
     import astor, ast
@@ -3,17 +3,33 @@ import config
 
 from model import *
 
-def decode_python_dataset(model, dataset, verbose=True):
+def decode_dataset_in_batches(model, dataset, beam_size=None, early_stop=None):
+    """
+    run beam search over `config.decode_batch_size` examples at a time,
+    yield each example with its list of candidates in dataset order.
+    `beam_size` defaults to `config.beam_size`, 1 for greedy decoding
+    """
+    if beam_size is None:
+        beam_size = config.beam_size
+
+    batch_size = max(config.decode_batch_size, 1)
+    for batch_start in xrange(0, dataset.count, batch_size):
+        examples = dataset.examples[batch_start:batch_start + batch_size]
+        cand_lists = model.decode_batch(examples, dataset.grammar, dataset.terminal_vocab,
+                                        beam_size=beam_size, max_time_step=config.decode_max_time_step,
+                                        early_stop=early_stop)
+
+        for example, cand_list in zip(examples, cand_lists):
+            yield example, cand_list
+
+def decode_python_dataset(model, dataset, verbose=True, beam_size=None, early_stop=None):
     from lang.py.parse import decode_tree_to_python_ast
     if verbose:
         logging.info('decoding [%s] set, num. examples: %d', dataset.name, dataset.count)
 
     decode_results = []
     cum_num = 0
-    for example in dataset.examples:
-        cand_list = model.decode(example, dataset.grammar, dataset.terminal_vocab,
-                                 beam_size=config.beam_size, max_time_step=config.decode_max_time_step)
-
+    for example, cand_list in decode_dataset_in_batches(model, dataset, beam_size, early_stop):
         exg_decode_results = []
         for cid, cand in enumerate(cand_list[:10]):
             try:
@@ -38,16 +54,13 @@ def decode_python_dataset(model, dataset, verbose=True):
 
     # serialize_to_file(decode_results, '%s.decode_results.profile' % dataset.name)
 
-def decode_ifttt_dataset(model, dataset, verbose=True):
+def decode_ifttt_dataset(model, dataset, verbose=True, beam_size=None, early_stop=None):
     if verbose:
         logging.info('decoding [%s] set, num. examples: %d', dataset.name, dataset.count)
 
     decode_results = []
     cum_num = 0
-    for example in dataset.examples:
-        cand_list = model.decode(example, dataset.grammar, dataset.terminal_vocab,
-                                 beam_size=config.beam_size, max_time_step=config.decode_max_time_step)
-
+    for example, cand_list in decode_dataset_in_batches(model, dataset, beam_size, early_stop):
         exg_decode_results = []
         for cid, cand in enumerate(cand_list[:10]):
             try:
@@ -1,4 +1,4 @@
-import argparse, sys
+import argparse, sys, time
 from nn.utils.generic_utils import init_logging
 from nn.utils.io_utils import deserialize_from_file, serialize_to_file
 from evaluation import *
@@ -6,14 +6,20 @@ from dataset import canonicalize_query, query_to_data
 from collections import namedtuple
 from lang.py.parse import decode_tree_to_python_ast
 from model import Model
+from components import DecodeBudget
+from bundle import load_bundle
 from dataset import DataEntry, DataSet, Vocab, Action
 import config
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-data_type', default='django', choices=['django', 'hs'])
-parser.add_argument('-data')
+parser.add_argument('-data', default='data/django.cleaned.dataset.freq5.par_info.refact.space_only.bin')
 parser.add_argument('-random_seed', default=181783, type=int)
-parser.add_argument('-model', default=None)
+parser.add_argument('-model', default='models/model.django_word128_encoder256_rule128_node64.beam15.adam.simple_trans.no_unary_closure.8e39832.run3.best_acc.npz')
+# an inference bundle exported by `code_gen.py export_bundle`, used instead of -data and -model
+parser.add_argument('-bundle', default=None)
+# the directory to cache the compiled Theano functions across runs, disabled if not set
+parser.add_argument('-func_cache_dir', default=None)
 
 # neural model's parameters
 parser.add_argument('-source_vocab_size', default=0, type=int)
@@ -63,59 +69,148 @@ parser.add_argument('-batch_size', default=10, type=int)
 parser.add_argument('-valid_per_batch', default=4000, type=int)
 parser.add_argument('-save_per_batch', default=4000, type=int)
 parser.add_argument('-valid_metric', default='bleu')
+# validate with greedy decoding instead of beam search
+parser.add_argument('-valid_greedy', action='store_true')
 
 # decoding
 parser.add_argument('-beam_size', default=15, type=int)
 parser.add_argument('-max_query_length', default=70, type=int)
 parser.add_argument('-decode_max_time_step', default=100, type=int)
+parser.add_argument('-decode_batch_size', default=10, type=int)
 parser.add_argument('-head_nt_constraint', dest='head_nt_constraint', action='store_true')
 parser.add_argument('-no_head_nt_constraint', dest='head_nt_constraint', action='store_false')
 parser.set_defaults(head_nt_constraint=True)
 
-args = parser.parse_args(args=['-data_type', 'django', '-data', 'data/django.cleaned.dataset.freq5.par_info.refact.space_only.bin',
-                               '-model', 'models/model.django_word128_encoder256_rule128_node64.beam15.adam.simple_trans.no_unary_closure.8e39832.run3.best_acc.npz'])
-if args.data_type == 'hs':
-    args.decode_max_time_step = 350
+# only score the legal rules of the frontier node when decoding, normalized over these rules
+parser.add_argument('-restricted_rule_softmax', dest='restricted_rule_softmax', action='store_true')
+parser.add_argument('-no_restricted_rule_softmax', dest='restricted_rule_softmax', action='store_false')
+parser.set_defaults(restricted_rule_softmax=False)
 
-logging.info('loading dataset [%s]', args.data)
-train_data, dev_data, test_data = deserialize_from_file(args.data)
+# only generate the tokens allowed by the type of value nodes, e.g. numbers for int values
+parser.add_argument('-value_token_type_mask', dest='value_token_type_mask', action='store_true')
+parser.add_argument('-no_value_token_type_mask', dest='value_token_type_mask', action='store_false')
+parser.set_defaults(value_token_type_mask=True)
 
-if not args.source_vocab_size:
-    args.source_vocab_size = train_data.annot_vocab.size
-if not args.target_vocab_size:
-    args.target_vocab_size = train_data.terminal_vocab.size
-if not args.rule_num:
-    args.rule_num = len(train_data.grammar.rules)
-if not args.node_num:
-    args.node_num = len(train_data.grammar.node_type_to_id)
+# the number of most frequent terminals in the vocab shortlist of the token head when decoding, 0 to disable
+parser.add_argument('-vocab_shortlist_size', default=0, type=int)
 
-config_module = sys.modules['config']
-for name, value in vars(args).iteritems():
-    setattr(config_module, name, value)
+# stop the beam search once the best completed candidate scores no lower than the live ones.
+# keeps the top candidate but may drop lower ones, which the evaluation falls back on when
+# the top one does not convert to code, so it is off by default, validation included
+parser.add_argument('-early_stop', dest='early_stop', action='store_true')
+parser.add_argument('-no_early_stop', dest='early_stop', action='store_false')
+parser.set_defaults(early_stop=False)
 
-# build the model
-model = Model()
-model.build()
-model.load(args.model)
+# drop the live hypotheses whose log probability is lower than the best candidate by more than this, 0 to disable
+parser.add_argument('-beam_prune_threshold', default=0., type=float)
 
-def decode_query(query):
-    """decode a given natural language query, return a list of generated candidates"""
+# the time limit in seconds and the max number of hypothesis expansions of decoding a query
+# in interactive mode, 0 for no limit. the candidates completed so far are returned when hit
+parser.add_argument('-decode_timeout', default=0., type=float)
+parser.add_argument('-decode_max_expansion_num', default=0, type=int)
+
+# ignore the unknown arguments, so that the module can be imported by other programs with their own flags
+args, _ = parser.parse_known_args()
+if args.data_type == 'hs':
+    args.decode_max_time_step = 350
+
+config_module = sys.modules['config']
+
+if args.bundle:
+    for name, value in vars(args).iteritems():
+        setattr(config_module, name, value)
+
+    # the bundle sets the model config and builds the model
+    begin_time = time.time()
+    model, grammar, annot_vocab, terminal_vocab = load_bundle(args.bundle)
+    logging.info('model built in %.2fs', time.time() - begin_time)
+else:
+    logging.info('loading dataset [%s]', args.data)
+    train_data, dev_data, test_data = deserialize_from_file(args.data)
+
+    if not args.source_vocab_size:
+        args.source_vocab_size = train_data.annot_vocab.size
+    if not args.target_vocab_size:
+        args.target_vocab_size = train_data.terminal_vocab.size
+    if not args.rule_num:
+        args.rule_num = len(train_data.grammar.rules)
+    if not args.node_num:
+        args.node_num = len(train_data.grammar.node_type_to_id)
+
+    for name, value in vars(args).iteritems():
+        setattr(config_module, name, value)
+
+    grammar, annot_vocab, terminal_vocab = train_data.grammar, train_data.annot_vocab, train_data.terminal_vocab
+
+    # build the model
+    model = Model()
+    begin_time = time.time()
+    model.build_inference()
+    logging.info('model built in %.2fs', time.time() - begin_time)
+    model.load(args.model, mmap_mode='r')
+    model.terminal_token_freq = train_data.get_terminal_token_freq()
+
+def query_to_example(query):
     query, str_map = canonicalize_query(query)
-    vocab = train_data.annot_vocab
+    vocab = annot_vocab
     query_tokens = query.split(' ')
     query_tokens_data = [query_to_data(query, vocab)]
     example = namedtuple('example', ['query', 'data'])(query=query_tokens, data=query_tokens_data)
 
-    cand_list = model.decode(example, train_data.grammar, train_data.terminal_vocab,
-                             beam_size=args.beam_size, max_time_step=args.decode_max_time_step, log=True)
+    return example
+
+def get_decode_budget():
+    return DecodeBudget(timeout=args.decode_timeout or None, max_expansion_num=args.decode_max_expansion_num or None)
+
+def decode_query(query):
+    """decode a given natural language query, return a list of generated candidates"""
+    example = query_to_example(query)
+
+    budget = get_decode_budget()
+    cand_list = model.decode(example, grammar, terminal_vocab,
+                             beam_size=args.beam_size, max_time_step=args.decode_max_time_step, log=True,
+                             budget=budget)
+
+    if budget.timed_out:
+        logging.warning('decoding is cut short by the %s: %s', budget.status, budget)
 
     return cand_list
 
+def decode_query_stream(query):
+    """
+    decode a given natural language query, yield a 'completed' DecodeEvent for each candidate
+    as soon as it is generated, and finally a 'finished' one with the sorted list of candidates.
+    stop iterating to cancel decoding
+    """
+    example = query_to_example(query)
+
+    budget = get_decode_budget()
+    for event in model.decode_iter(example, grammar, terminal_vocab,
+                                   beam_size=args.beam_size, max_time_step=args.decode_max_time_step, log=True,
+                                   budget=budget):
+        if event.kind == 'finished' and budget.timed_out:
+            logging.warning('decoding is cut short by the %s: %s', budget.status, budget)
+
+        yield event
+
 if __name__ == '__main__':
     print 'run in interactive mode'
     while True:
         query = raw_input('input a query: ')
-        cand_list = decode_query(query)
+
+        # show the first candidate as soon as it is generated
+        cand_list = []
+        first_cand = None
+        for event in decode_query_stream(query):
+            if event.kind == 'finished':
+                cand_list = event.cand_list
+            elif first_cand is None:
+                first_cand = event.hyp
+                print 'first cand at time step %d, score: %f' % (event.step, event.score)
+                try:
+                    print 'code: ', astor.to_source(decode_tree_to_python_ast(first_cand.tree))
+                except:
+                    print 'code: <failed to convert the tree to code>'
 
         # output top 5 candidates
         for cid, cand in enumerate(cand_list[:5]):
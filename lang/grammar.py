@@ -1,5 +1,6 @@
 from collections import OrderedDict, defaultdict
 import logging
+import numpy as np
 
 from astnode import ASTNode
 from lang.util import typename
@@ -61,6 +62,109 @@ class Grammar(object):
         else:
             KeyError('key=%s' % key_node)
 
+    def init_rule_tables(self):
+        """
+        precompute for each rule id the node type ids of its child nodes, whether
+        each child is a value node, and the children that can be expanded by further
+        actions. Also precompute for each node type id the ids of the rules with that
+        type as LHS, as an int array in the order of `grammar[node]`, as a boolean
+        mask over all rules, and as a padded rule id table with its mask.
+        Datasets pickled before these tables existed build them on first use
+        """
+        self._rule_child_type_ids = []
+        self._rule_child_is_value = []
+        self._rule_frontier_child_ids = []
+
+        for rule_id in xrange(len(self.rules)):
+            rule = self.id_to_rule[rule_id]
+
+            child_type_ids = tuple(self.get_node_type_id(child.type) for child in rule.children)
+            child_is_value = tuple(self.is_value_node(child) for child in rule.children)
+            # value nodes and non-terminal nodes become frontier nodes
+            frontier_child_ids = tuple(i for i, child in enumerate(rule.children)
+                                       if child_is_value[i] or not self.is_terminal(child))
+
+            self._rule_child_type_ids.append(child_type_ids)
+            self._rule_child_is_value.append(child_is_value)
+            self._rule_frontier_child_ids.append(frontier_child_ids)
+
+        type_num = len(self.node_type_to_id)
+        self._lhs_rule_ids = [np.zeros(0, dtype='int32') for _ in xrange(type_num)]
+        self._lhs_rule_mask = np.zeros((type_num, len(self.rules)), dtype='bool')
+
+        for lhs, rules in self.rule_index.iteritems():
+            type_id = self.get_node_type_id(lhs.type)
+            rule_ids = np.array([self.rule_to_id[rule] for rule in rules], dtype='int32')
+
+            self._lhs_rule_ids[type_id] = rule_ids
+            self._lhs_rule_mask[type_id, rule_ids] = True
+
+        # the rule ids of each node type padded into a matrix, (type_num, max_lhs_rule_num),
+        # and the mask of the padding. used to only score the legal rules of a frontier node
+        max_lhs_rule_num = max(len(rule_ids) for rule_ids in self._lhs_rule_ids)
+        self._lhs_rule_id_table = np.zeros((type_num, max_lhs_rule_num), dtype='int32')
+        self._lhs_rule_id_table_mask = np.zeros((type_num, max_lhs_rule_num), dtype='float32')
+
+        for type_id, rule_ids in enumerate(self._lhs_rule_ids):
+            self._lhs_rule_id_table[type_id, :len(rule_ids)] = rule_ids
+            self._lhs_rule_id_table_mask[type_id, :len(rule_ids)] = 1.
+
+    @property
+    def lhs_rule_ids(self):
+        if not hasattr(self, '_lhs_rule_ids'):
+            self.init_rule_tables()
+
+        return self._lhs_rule_ids
+
+    @property
+    def lhs_rule_mask(self):
+        if not hasattr(self, '_lhs_rule_mask'):
+            self.init_rule_tables()
+
+        return self._lhs_rule_mask
+
+    @property
+    def lhs_rule_id_table(self):
+        if not hasattr(self, '_lhs_rule_id_table'):
+            self.init_rule_tables()
+
+        return self._lhs_rule_id_table
+
+    @property
+    def lhs_rule_id_table_mask(self):
+        if not hasattr(self, '_lhs_rule_id_table_mask'):
+            self.init_rule_tables()
+
+        return self._lhs_rule_id_table_mask
+
+    @property
+    def rule_child_type_ids(self):
+        if not hasattr(self, '_rule_child_type_ids'):
+            self.init_rule_tables()
+
+        return self._rule_child_type_ids
+
+    @property
+    def rule_child_is_value(self):
+        if not hasattr(self, '_rule_child_is_value'):
+            self.init_rule_tables()
+
+        return self._rule_child_is_value
+
+    @property
+    def rule_frontier_child_ids(self):
+        if not hasattr(self, '_rule_frontier_child_ids'):
+            self.init_rule_tables()
+
+        return self._rule_frontier_child_ids
+
+    def get_value_token_masks(self, terminal_vocab):
+        """
+        boolean masks over `terminal_vocab` of the tokens allowed in the value nodes
+        of each node type, (type_num, terminal_vocab_size). None if not restricted
+        """
+        return None
+
     def get_node_type_id(self, node):
         from astnode import ASTNode
 
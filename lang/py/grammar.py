@@ -3,7 +3,9 @@ Python grammar and typing system
 """
 import ast
 import inspect
+import re
 import astor
+import numpy as np
 
 from lang.grammar import Grammar
 
@@ -723,6 +725,37 @@ def is_builtin_type(x):
     return x == str or x == int or x == float or x == bool or x == object or x == 'identifier'
 
 
+def is_int_token(token):
+    try:
+        int(token)
+        return True
+    except ValueError:
+        return False
+
+
+def is_float_token(token):
+    # `float` also accepts nan and inf
+    if not token or token[0] not in '0123456789+-.':
+        return False
+
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+p_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# the tokens allowed in the values of each builtin type. str and object values are not restricted
+VALUE_TOKEN_CHECKERS = {
+    'int': is_int_token,
+    'float': is_float_token,
+    'bool': lambda token: token in ('True', 'False'),
+    'identifier': lambda token: p_identifier.match(token) is not None
+}
+
+
 def is_terminal_ast_type(x):
     if inspect.isclass(x) and x in TERMINAL_AST_TYPES:
         return True
@@ -835,3 +868,27 @@ class PythonGrammar(Grammar):
 
     def is_value_node(self, node):
         return is_builtin_type(node.type)
+
+    def get_value_token_masks(self, terminal_vocab):
+        """
+        boolean masks over `terminal_vocab` of the tokens allowed in the value nodes
+        of each node type, (type_num, terminal_vocab_size). <eos> and <unk> are always
+        allowed. the masks are built once for each terminal vocab
+        """
+        if getattr(self, '_value_token_mask_vocab', None) is not terminal_vocab:
+            masks = np.ones((len(self.node_type_to_id), terminal_vocab.size), dtype='bool')
+
+            for type_name, type_id in self.node_type_to_id.iteritems():
+                if type_name not in VALUE_TOKEN_CHECKERS:
+                    continue
+
+                checker = VALUE_TOKEN_CHECKERS[type_name]
+                masks[type_id] = False
+                for token, tid in terminal_vocab.iteritems():
+                    if token in ('<eos>', '<unk>') or checker(token):
+                        masks[type_id, tid] = True
+
+            self._value_token_masks = masks
+            self._value_token_mask_vocab = terminal_vocab
+
+        return self._value_token_masks
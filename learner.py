@@ -98,8 +98,12 @@ class Learner(object):
                 if cum_updates % config.valid_per_batch == 0:
                     logging.info('begin validation')
 
+                    # greedy decoding is much faster than beam search for model selection
+                    valid_beam_size = 1 if config.valid_greedy else None
+
                     if config.data_type == 'ifttt':
-                        decode_results = decoder.decode_ifttt_dataset(self.model, self.val_data, verbose=False)
+                        decode_results = decoder.decode_ifttt_dataset(self.model, self.val_data, verbose=False,
+                                                                      beam_size=valid_beam_size, early_stop=config.early_stop)
                         channel_acc, channel_func_acc, prod_f1 = evaluation.evaluate_ifttt_results(self.val_data, decode_results, verbose=False)
 
                         val_perf = channel_func_acc
@@ -107,7 +111,8 @@ class Learner(object):
                         logging.info('channel+func accuracy: %f', channel_func_acc)
                         logging.info('prod F1: %f', prod_f1)
                     else:
-                        decode_results = decoder.decode_python_dataset(self.model, self.val_data, verbose=False)
+                        decode_results = decoder.decode_python_dataset(self.model, self.val_data, verbose=False,
+                                                                       beam_size=valid_beam_size, early_stop=config.early_stop)
                         bleu, accuracy = evaluation.evaluate_decode_results(self.val_data, decode_results, verbose=False)
 
                         val_perf = eval(config.valid_metric)
@@ -0,0 +1,204 @@
+"""
+start the server with each number of workers in turn, send it queries from concurrent clients,
+and report the latency percentiles, the throughput and the memory of the server processes.
+the arguments not listed below are passed to server.py, e.g.
+
+python load_test.py -workers 1 2 4 8 -request_num 500 -concurrency 16 -bundle bundle -func_cache_dir cache
+"""
+import argparse
+import sys
+import os
+import time
+import json
+import httplib
+import threading
+import subprocess
+
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-workers', default=[1, 2, 4], type=int, nargs='+')
+parser.add_argument('-request_num', default=200, type=int)
+parser.add_argument('-concurrency', default=8, type=int)
+# the queries to send, one per line
+parser.add_argument('-query_file', default=None)
+parser.add_argument('-server_script', default='server.py')
+parser.add_argument('-host', default='127.0.0.1')
+parser.add_argument('-port', default=8000, type=int)
+parser.add_argument('-startup_timeout', default=600, type=float)
+
+DEFAULT_QUERIES = ['call the function foo with an argument bar',
+                   'if x is None , return an empty list',
+                   'define the method __init__ with 2 arguments self and name',
+                   'substitute value under the key "name" of the self.data dictionary for value',
+                   'for every i in range of integers from 0 to length of x',
+                   'raise an ValueError exception with string "invalid value" as an argument',
+                   'import module os',
+                   'return self.name']
+
+
+def request(host, port, path, json_request=None):
+    conn = httplib.HTTPConnection(host, port)
+    try:
+        if json_request is None:
+            conn.request('GET', path)
+        else:
+            conn.request('POST', path, json.dumps(json_request), {'Content-Type': 'application/json'})
+
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def wait_for_server(proc, args):
+    begin_time = time.time()
+    while time.time() - begin_time < args.startup_timeout:
+        if proc.poll() is not None:
+            raise RuntimeError('the server exits with code %d' % proc.returncode)
+
+        try:
+            return request(args.host, args.port, '/stats')
+        except Exception:
+            time.sleep(1)
+
+    raise RuntimeError('the server does not start in %ds' % args.startup_timeout)
+
+
+def get_process_tree(pid):
+    """
+    `pid` and the pids of its children
+    """
+    pids = [pid]
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+
+        if ppid == pid:
+            pids.append(int(name))
+
+    return pids
+
+
+def get_memory(pids):
+    """
+    the total resident (RSS) and proportional (PSS) set size of the processes in MB. The pages
+    shared by n processes are counted n times in RSS, and 1/n each in PSS
+    """
+    rss = pss = 0
+    for pid in pids:
+        try:
+            with open('/proc/%d/smaps' % pid) as f:
+                for line in f:
+                    if line.startswith('Rss:'):
+                        rss += int(line.split()[1])
+                    elif line.startswith('Pss:'):
+                        pss += int(line.split()[1])
+        except IOError:
+            continue
+
+    return rss / 1024., pss / 1024.
+
+
+def run_clients(queries, args):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    next_request = [0]
+
+    def client():
+        while True:
+            with lock:
+                request_id = next_request[0]
+                next_request[0] += 1
+            if request_id >= args.request_num:
+                return
+
+            query = queries[request_id % len(queries)]
+            begin_time = time.time()
+            try:
+                response = request(args.host, args.port, '/decode', {'query': query})
+            except Exception:
+                response = {'error': 'request failed'}
+            latency = time.time() - begin_time
+
+            with lock:
+                if 'error' in response:
+                    errors[0] += 1
+                else:
+                    latencies.append(latency)
+
+    begin_time = time.time()
+    threads = [threading.Thread(target=client) for _ in xrange(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - begin_time
+
+    return latencies, errors[0], elapsed
+
+
+def load_test(worker_num, queries, server_args, args):
+    cmd = [sys.executable, args.server_script, '-workers', str(worker_num),
+           '-host', args.host, '-port', str(args.port)] + server_args
+    proc = subprocess.Popen(cmd)
+
+    try:
+        wait_for_server(proc, args)
+        # memory after the workers are forked and before they decode
+        cold_rss, cold_pss = get_memory(get_process_tree(proc.pid))
+
+        # warm up each worker once
+        run_clients(queries, argparse.Namespace(request_num=worker_num, concurrency=worker_num,
+                                                host=args.host, port=args.port))
+
+        latencies, error_num, elapsed = run_clients(queries, args)
+        rss, pss = get_memory(get_process_tree(proc.pid))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    result = {'workers': worker_num,
+              'requests': len(latencies),
+              'errors': error_num,
+              'throughput': len(latencies) / elapsed,
+              'cold_rss_mb': cold_rss,
+              'cold_pss_mb': cold_pss,
+              'rss_mb': rss,
+              'pss_mb': pss}
+
+    if latencies:
+        result['p50'] = np.percentile(latencies, 50)
+        result['p99'] = np.percentile(latencies, 99)
+
+    return result
+
+
+if __name__ == '__main__':
+    args, server_args = parser.parse_known_args()
+
+    if args.query_file:
+        with open(args.query_file) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = DEFAULT_QUERIES
+
+    results = []
+    for worker_num in args.workers:
+        results.append(load_test(worker_num, queries, server_args, args))
+
+    print '%8s %8s %6s %10s %10s %10s %14s %14s %10s %10s' % \
+          ('workers', 'requests', 'errors', 'p50 (ms)', 'p99 (ms)', 'req/s',
+           'cold rss (MB)', 'cold pss (MB)', 'rss (MB)', 'pss (MB)')
+    for result in results:
+        print '%8d %8d %6d %10.1f %10.1f %10.2f %14.1f %14.1f %10.1f %10.1f' % \
+              (result['workers'], result['requests'], result['errors'],
+               result.get('p50', float('nan')) * 1000, result.get('p99', float('nan')) * 1000,
+               result['throughput'], result['cold_rss_mb'], result['cold_pss_mb'],
+               result['rss_mb'], result['pss_mb'])
@@ -8,6 +8,10 @@ import logging
 import copy
 import heapq
 import sys
+import os
+import hashlib
+import inspect
+import cPickle
 
 from nn.layers.embeddings import Embedding
 from nn.layers.core import Dense, Dropout, WordDropout
@@ -16,14 +20,29 @@ import nn.optimizers as optimizers
 import nn.initializations as initializations
 from nn.activations import softmax
 from nn.utils.theano_utils import *
+from nn.utils.io_utils import save_npy_dir, load_npy_dir
+import nn
 
 from config import config_info
 import config
 from lang.grammar import Grammar
 from parse import *
 from astnode import *
-from util import is_numeric
-from components import Hyp, PointerNet, CondAttLSTM
+from util import is_numeric, top_k_ids
+from components import Hyp, DecodeJob, DecodeEvent, PointerNet, CondAttLSTM
+import components
+
+# the config values that the compiled functions depend on, part of the key of the function cache
+FUNC_CACHE_CONFIG_NAMES = ['source_vocab_size', 'target_vocab_size', 'rule_num', 'node_num',
+                           'word_embed_dim', 'rule_embed_dim', 'node_embed_dim', 'encoder_hidden_dim',
+                           'decoder_hidden_dim', 'attention_hidden_dim', 'ptrnet_hidden_dim', 'dropout',
+                           'encoder', 'parent_hidden_state_feed', 'parent_action_feed', 'frontier_node_type_feed',
+                           'tree_attention', 'max_query_length', 'optimizer', 'clip_grad',
+                           'restricted_rule_softmax', 'vocab_shortlist_size']
+
+# the Theano flags that the compiled functions depend on
+FUNC_CACHE_THEANO_FLAGS = ['floatX', 'device', 'mode', 'optimizer', 'linker', 'cxx', 'openmp',
+                           'optimizer_including', 'optimizer_excluding']
 
 sys.setrecursionlimit(50000)
 
@@ -71,7 +90,149 @@ class Model:
 
         self.srng = RandomStreams()
 
+        # the frequency of each terminal token in the training set, used to
+        # build the vocab shortlist of the token head when decoding
+        self.terminal_token_freq = None
+
     def build(self):
+        # build both the training function and the decoding functions
+        self.build_training()
+        self.build_inference()
+
+    def build_inference(self):
+        """
+        only build the decoding functions, for processes that never train the model,
+        which skips computing the gradients and compiling `train_func`
+        """
+        if self.load_cached_funcs('inference'):
+            return
+
+        self.build_inference_funcs()
+
+        self.save_cached_funcs('inference', [name for name in vars(self) if name.startswith('decoder_func_')])
+
+    def build_training(self):
+        if self.load_cached_funcs('training'):
+            return
+
+        self.build_training_funcs()
+
+        self.save_cached_funcs('training', ['train_func'])
+
+    def get_func_cache_file(self, kind):
+        """
+        the file of the compiled functions of `kind` ('inference' or 'training') in `config.func_cache_dir`,
+        named by a hash of the config values and Theano flags that the functions depend on, and of the
+        code that builds them
+        """
+        key_items = [kind, theano.__version__]
+        key_items += ['%s=%r' % (name, getattr(config, name, None)) for name in FUNC_CACHE_CONFIG_NAMES]
+        key_items += ['%s=%r' % (name, getattr(theano.config, name, None)) for name in FUNC_CACHE_THEANO_FLAGS]
+        key_items += [inspect.getsource(sys.modules[__name__]), inspect.getsource(components)]
+        key_hash = hashlib.md5('\n'.join(key_items))
+
+        # the layers, activations, initializations and optimizers that the graphs are built from
+        nn_dir = os.path.dirname(os.path.abspath(nn.__file__))
+        for dir_path, dir_names, file_names in sorted(os.walk(nn_dir)):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if file_name.endswith('.py'):
+                    file_path = os.path.join(dir_path, file_name)
+                    with open(file_path, 'rb') as f:
+                        key_hash.update(os.path.relpath(file_path, nn_dir) + '\n' + f.read())
+
+        key = key_hash.hexdigest()
+
+        return os.path.join(config.func_cache_dir, 'funcs.%s.%s.pkl' % (kind, key))
+
+    def get_param_persistent_ids(self):
+        # the parameters, their containers, storage and values are pickled by reference,
+        # so that the cached functions share the storage of the parameters of this model
+        persistent_ids = dict()
+        for i, p in enumerate(self.params):
+            persistent_ids[id(p)] = ('param', i)
+            persistent_ids[id(p.container)] = ('param_container', i)
+            persistent_ids[id(p.container.storage)] = ('param_storage', i)
+            persistent_ids[id(p.get_value(borrow=True))] = ('param_value', i)
+
+        return persistent_ids
+
+    def save_cached_funcs(self, kind, func_names):
+        if not getattr(config, 'func_cache_dir', None):
+            return
+
+        cache_file = self.get_func_cache_file(kind)
+        logging.info('save compiled %s functions to [%s]', kind, cache_file)
+
+        persistent_ids = self.get_param_persistent_ids()
+        funcs = dict((name, getattr(self, name)) for name in func_names)
+
+        if not os.path.exists(config.func_cache_dir):
+            os.makedirs(config.func_cache_dir)
+
+        # write to a temporary file first, so that other processes never read a partial cache
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 50000))
+        with open(tmp_file, 'wb') as f:
+            pickler = cPickle.Pickler(f, protocol=cPickle.HIGHEST_PROTOCOL)
+            pickler.persistent_id = lambda obj: persistent_ids.get(id(obj))
+            pickler.dump(funcs)
+
+        os.rename(tmp_file, cache_file)
+
+    def load_cached_funcs(self, kind):
+        """
+        load the compiled functions of `kind` from the function cache, return False
+        if they are not cached
+        """
+        if not getattr(config, 'func_cache_dir', None):
+            return False
+
+        cache_file = self.get_func_cache_file(kind)
+        if not os.path.exists(cache_file):
+            return False
+
+        logging.info('load compiled %s functions from [%s]', kind, cache_file)
+
+        def persistent_load(persistent_id):
+            ref_type, i = persistent_id
+            p = self.params[i]
+            if ref_type == 'param':
+                return p
+            elif ref_type == 'param_container':
+                return p.container
+            elif ref_type == 'param_storage':
+                return p.container.storage
+            else:
+                return p.get_value(borrow=True)
+
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 50000))
+        try:
+            with open(cache_file, 'rb') as f:
+                unpickler = cPickle.Unpickler(f)
+                unpickler.persistent_load = persistent_load
+                funcs = unpickler.load()
+        except Exception:
+            logging.warning('fail to load the compiled %s functions from [%s], rebuild them',
+                            kind, cache_file, exc_info=True)
+            return False
+
+        for name, func in funcs.iteritems():
+            setattr(self, name, func)
+
+        return True
+
+    def build_inference_funcs(self):
+        # (batch_size, max_query_length)
+        query_tokens = ndim_itensor(2, 'query_tokens')
+
+        # (batch_size, max_query_length, query_token_embed_dim)
+        # (batch_size, max_query_length)
+        query_token_embed, query_token_embed_mask = self.query_embedding(query_tokens, mask_zero=True)
+
+        self.build_decoder(query_tokens, query_token_embed, query_token_embed_mask)
+
+    def build_training_funcs(self):
         # (batch_size, max_example_action_num, action_type)
         tgt_action_seq = ndim_itensor(3, 'tgt_action_seq')
 
@@ -213,8 +374,6 @@ class Model:
         # else:
         #     self.build_decoder(query_tokens, query_token_embed, query_token_embed_mask)
 
-        self.build_decoder(query_tokens, query_token_embed, query_token_embed_mask)
-
     def build_decoder(self, query_tokens, query_token_embed, query_token_embed_mask):
         logging.info('building decoder ...')
 
@@ -227,6 +386,12 @@ class Model:
         # (batch_size, n_timestep, decoder_state_dim)
         hist_h = ndim_tensor(3, name='hist_h')
 
+        # (batch_size, n_timestep, attention_hidden_dim)
+        hist_h_att_trans = ndim_tensor(3, name='hist_h_att_trans')
+
+        # (batch_size, decoder_state_dim)
+        parent_h = ndim_tensor(2, name='parent_h')
+
         # (batch_size, decoder_state_dim)
         prev_action_embed = ndim_tensor(2, name='prev_action_embed')
 
@@ -253,9 +418,26 @@ class Model:
         # (batch_size, 1)
         parent_t_reshaped = T.shape_padright(parent_t)
 
+        # (query_num, max_query_length, query_embed_dim)
         query_embed = self.query_encoder_lstm(query_token_embed, mask=query_token_embed_mask,
                                               dropout=config.dropout, train=False)
 
+        # query-only terms, computed once per query by `decoder_func_init`
+        # (query_num, max_query_length, att_hidden_dim)
+        query_context_att_trans = self.decoder_lstm.get_context_att_trans(query_embed)
+
+        # (query_num, max_query_length, ptrnet_hidden_dim)
+        query_ptr_net_trans = self.src_ptr_net.dense1_input(query_embed)
+
+        # (batch_size), the query that each hypothesis belongs to
+        hyp_query_id = T.ivector(name='hyp_query_id')
+
+        # (batch_size, max_query_length, ...)
+        hyp_query_embed = query_embed[hyp_query_id]
+        hyp_query_token_embed_mask = query_token_embed_mask[hyp_query_id]
+        hyp_context_att_trans = query_context_att_trans[hyp_query_id]
+        hyp_ptr_net_trans = query_ptr_net_trans[hyp_query_id]
+
         # (batch_size, 1, decoder_state_dim)
         prev_action_embed_reshaped = prev_action_embed.dimshuffle((0, 'x', 1))
 
@@ -276,16 +458,33 @@ class Model:
         # (batch_size, 1, decoder_state_dim)
         # (batch_size, 1, decoder_state_dim)
         # (batch_size, 1, field_token_encode_dim)
-        decoder_next_state_dim3, decoder_next_cell_dim3, ctx_vectors = self.decoder_lstm(decoder_input,
-                                                                                         init_state=decoder_prev_state,
-                                                                                         init_cell=decoder_prev_cell,
-                                                                                         hist_h=hist_h,
-                                                                                         context=query_embed,
-                                                                                         context_mask=query_token_embed_mask,
-                                                                                         parent_t_seq=parent_t_reshaped,
-                                                                                         dropout=config.dropout,
-                                                                                         train=False,
-                                                                                         time_steps=time_steps)
+        if config.tree_attention:
+            # attention over history needs the history of hidden states so far,
+            # together with their cached projections
+            decoder_next_state_dim3, decoder_next_cell_dim3, ctx_vectors = self.decoder_lstm(decoder_input,
+                                                                                             init_state=decoder_prev_state,
+                                                                                             init_cell=decoder_prev_cell,
+                                                                                             hist_h=hist_h,
+                                                                                             hist_h_att_trans=hist_h_att_trans,
+                                                                                             context=hyp_query_embed,
+                                                                                             context_mask=hyp_query_token_embed_mask,
+                                                                                             context_att_trans=hyp_context_att_trans,
+                                                                                             parent_t_seq=parent_t_reshaped,
+                                                                                             dropout=config.dropout,
+                                                                                             train=False,
+                                                                                             time_steps=time_steps)
+        else:
+            # otherwise only the hidden state of the parent action is used
+            decoder_next_state_dim3, decoder_next_cell_dim3, ctx_vectors = self.decoder_lstm(decoder_input,
+                                                                                             init_state=decoder_prev_state,
+                                                                                             init_cell=decoder_prev_cell,
+                                                                                             parent_h=parent_h,
+                                                                                             context=hyp_query_embed,
+                                                                                             context_mask=hyp_query_token_embed_mask,
+                                                                                             context_att_trans=hyp_context_att_trans,
+                                                                                             dropout=config.dropout,
+                                                                                             train=False,
+                                                                                             time_steps=time_steps)
 
         decoder_next_state = decoder_next_state_dim3.flatten(2)
         # decoder_output = decoder_next_state * (1 - DECODER_DROPOUT)
@@ -297,279 +496,764 @@ class Model:
 
         rule_prob = softmax(T.dot(decoder_next_state_trans_rule, T.transpose(self.rule_embedding_W)) + self.rule_embedding_b)
 
+        # the rule head restricted to the legal rules of the frontier node of each hypothesis,
+        # normalized over these rules only. (batch_size, max_lhs_rule_num)
+        legal_rule_ids = T.imatrix(name='legal_rule_ids')
+        legal_rule_mask = T.matrix(name='legal_rule_mask')
+
+        legal_rule_logits = T.sum(decoder_next_state_trans_rule[:, None, :] * self.rule_embedding_W[legal_rule_ids], axis=-1) + \
+                            self.rule_embedding_b[legal_rule_ids]
+        legal_rule_logits = T.switch(legal_rule_mask > 0, legal_rule_logits, np.float32(-1e20))
+        legal_rule_prob = softmax(legal_rule_logits)
+
         gen_action_prob = self.terminal_gen_softmax(decoder_next_state)
 
         vocab_prob = softmax(T.dot(decoder_next_state_trans_token, T.transpose(self.vocab_embedding_W)) + self.vocab_embedding_b)
 
+        # the token head restricted to the vocab shortlist of the query of each hypothesis,
+        # normalized over the shortlist. (query_num, max_shortlist_size)
+        vocab_shortlist = T.imatrix(name='vocab_shortlist')
+        vocab_shortlist_mask = T.matrix(name='vocab_shortlist_mask')
+
+        # (batch_size, max_shortlist_size)
+        hyp_vocab_shortlist = vocab_shortlist[hyp_query_id]
+        shortlist_logits = T.sum(decoder_next_state_trans_token[:, None, :] * self.vocab_embedding_W[hyp_vocab_shortlist], axis=-1) + \
+                           self.vocab_embedding_b[hyp_vocab_shortlist]
+        shortlist_logits = T.switch(vocab_shortlist_mask[hyp_query_id] > 0, shortlist_logits, np.float32(-1e20))
+        shortlist_vocab_prob = softmax(shortlist_logits)
+
         ptr_net_decoder_state = T.concatenate([decoder_next_state_dim3, ctx_vectors], axis=-1)
 
-        copy_prob = self.src_ptr_net(query_embed, query_token_embed_mask, ptr_net_decoder_state)
+        copy_prob = self.src_ptr_net(hyp_query_embed, hyp_query_token_embed_mask, ptr_net_decoder_state,
+                                     query_embed_trans=hyp_ptr_net_trans)
 
         copy_prob = copy_prob.flatten(2)
 
         inputs = [query_tokens]
-        outputs = [query_embed, query_token_embed_mask]
+        outputs = [query_embed, query_token_embed_mask, query_context_att_trans, query_ptr_net_trans]
 
         self.decoder_func_init = theano.function(inputs, outputs)
 
-        inputs = [time_steps, decoder_prev_state, decoder_prev_cell, hist_h, prev_action_embed,
-                  node_id, par_rule_id, parent_t,
-                  query_embed, query_token_embed_mask]
+        # `hist_h`, `hist_h_att_trans` and `parent_t` with tree attention, `parent_h` otherwise
+        if config.tree_attention:
+            hist_inputs = [hist_h, hist_h_att_trans, parent_t]
+        else:
+            hist_inputs = [parent_h]
+
+        inputs = [time_steps, decoder_prev_state, decoder_prev_cell, prev_action_embed,
+                  node_id, par_rule_id] + hist_inputs + \
+                 [query_embed, query_token_embed_mask, query_context_att_trans, query_ptr_net_trans,
+                  hyp_query_id]
+
+        # with tree attention, also output the projection of the new
+        # hidden states, which is appended to the cache of each hypothesis
+        if config.tree_attention:
+            state_outputs = [decoder_next_state, decoder_next_cell,
+                             self.decoder_lstm.get_hist_h_att_trans(decoder_next_state)]
+        else:
+            state_outputs = [decoder_next_state, decoder_next_cell]
+
+        # a hypothesis either expands its frontier node with a rule, or generates a token
+        # for a value node, so we compile a step function with only the rule head and one
+        # with only the token and copy heads. the rule head does not use the pointer net
+        self.decoder_func_next_step_rule = theano.function(inputs, state_outputs + [rule_prob],
+                                                           on_unused_input='ignore')
+
+        self.decoder_func_next_step_token = theano.function(inputs, state_outputs +
+                                                            [gen_action_prob, vocab_prob, copy_prob])
+
+        if config.vocab_shortlist_size > 0:
+            self.decoder_func_next_step_shortlist_token = theano.function(inputs + [vocab_shortlist, vocab_shortlist_mask],
+                                                                          state_outputs + [gen_action_prob, shortlist_vocab_prob,
+                                                                                           copy_prob])
+
+        if config.restricted_rule_softmax:
+            self.decoder_func_next_step_legal_rule = theano.function(inputs + [legal_rule_ids, legal_rule_mask],
+                                                                     state_outputs + [legal_rule_prob],
+                                                                     on_unused_input='ignore')
+
+    def decode(self, example, grammar, terminal_vocab, beam_size, max_time_step, log=False, early_stop=None,
+               budget=None):
+        # beam search decoding, optionally within a `DecodeBudget`
+        return self.decode_batch([example], grammar, terminal_vocab, beam_size, max_time_step,
+                                 log=log, early_stop=early_stop, budgets=[budget])[0]
+
+    def decode_iter(self, example, grammar, terminal_vocab, beam_size, max_time_step, log=False, early_stop=None,
+                    budget=None):
+        # streaming beam search decoding, see `decode_batch_iter`
+        return self.decode_batch_iter([example], grammar, terminal_vocab, beam_size, max_time_step,
+                                      log=log, early_stop=early_stop, budgets=[budget])
+
+    def decode_batch(self, examples, grammar, terminal_vocab, beam_size, max_time_step, log=False, early_stop=None,
+                     budgets=None):
+        """
+        beam search decoding over a batch of examples, see `decode_batch_iter`.
+        return a list of sorted completed hypotheses for each example
+        """
+
+        cand_lists = [None] * len(examples)
+        for event in self.decode_batch_iter(examples, grammar, terminal_vocab, beam_size, max_time_step,
+                                            log=log, early_stop=early_stop, budgets=budgets):
+            if event.kind == 'finished':
+                cand_lists[event.example_id] = event.cand_list
+
+        return cand_lists
+
+    def decode_batch_iter(self, examples, grammar, terminal_vocab, beam_size, max_time_step, log=False,
+                          early_stop=None, budgets=None):
+        """
+        beam search decoding over a batch of examples. the live hypotheses of all the
+        examples are stacked into one matrix, so that each time step makes a single call
+        to each decoder step function. examples whose search has finished drop out of the batch.
+        with `beam_size=1` it is greedy decoding, which updates a single hypothesis in place.
+        with `early_stop` (default `config.early_stop`) the search of an example stops once
+        its best completed hypothesis scores no lower than all the live ones, which keeps
+        the top hypothesis but may drop lower ones. `budgets` is a list of `DecodeBudget`
+        (or None) for each example, whose search stops with the hypotheses completed so
+        far once its budget is exhausted.
+
+        it is a generator of `DecodeEvent`: a 'completed' event for each hypothesis as soon
+        as it is completed, and a 'finished' event with the sorted completed hypotheses of
+        an example once its search ends. Closing the generator cancels the search
+        """
+
+        if early_stop is None:
+            early_stop = config.early_stop
+
+        jobs = [DecodeJob(example, grammar, terminal_vocab, beam_size) for example in examples]
+        if beam_size == 1:
+            for job in jobs:
+                job.hyp_samples[0].actions = []
+
+        query_batch = self.encode_queries(jobs)
+
+        vocab_shortlist = None
+        if config.vocab_shortlist_size > 0:
+            vocab_shortlist = self.get_vocab_shortlist(jobs, terminal_vocab)
+
+        # the number of completed hypotheses of each example already yielded, and whether
+        # its 'finished' event is yielded
+        yielded_hyp_nums = [0] * len(jobs)
+        yielded_finished = [False] * len(jobs)
+
+        self.start_budgets(budgets)
+        try:
+            for t in xrange(max_time_step):
+                if budgets is not None:
+                    self.spend_budgets(jobs, budgets)
+
+                live_job_ids = [i for i, job in enumerate(jobs) if not job.finished]
+                if not live_job_ids:
+                    break
+
+                if beam_size == 1:
+                    self.greedy_search_step(jobs, live_job_ids, t, grammar, terminal_vocab,
+                                            query_batch, vocab_shortlist, log=log)
+                else:
+                    self.beam_search_step(jobs, live_job_ids, t, grammar, terminal_vocab, beam_size,
+                                          query_batch, vocab_shortlist, log=log, early_stop=early_stop)
+
+                for event in self.get_decode_events(jobs, budgets, t + 1, yielded_hyp_nums, yielded_finished):
+                    yield event
+
+            # the search of the remaining examples ends at the max time step
+            for job in jobs:
+                job.finished = True
+
+            for event in self.get_decode_events(jobs, budgets, max_time_step, yielded_hyp_nums, yielded_finished):
+                yield event
+        finally:
+            for budget in budgets or []:
+                if budget is not None:
+                    budget.finish('cancelled')
+
+    def get_decode_events(self, jobs, budgets, step, yielded_hyp_nums, yielded_finished):
+        """
+        the events of the hypotheses completed since the last call, and of the examples
+        whose search has ended, at time step `step`
+        """
+        for i, job in enumerate(jobs):
+            if yielded_finished[i]:
+                continue
+
+            for hyp in job.completed_hyps[yielded_hyp_nums[i]:]:
+                yield DecodeEvent('completed', i, hyp, hyp.score, hyp.n_timestep, None)
+            yielded_hyp_nums[i] = len(job.completed_hyps)
+
+            if job.finished:
+                yielded_finished[i] = True
+                if budgets is not None and budgets[i] is not None:
+                    budgets[i].finish('finished')
+
+                cand_list = sorted(job.completed_hyps, key=lambda x: x.score, reverse=True)
+                top_hyp = cand_list[0] if cand_list else None
+                yield DecodeEvent('finished', i, top_hyp, top_hyp.score if top_hyp else None, step, cand_list)
+
+    def beam_search_step(self, jobs, live_job_ids, t, grammar, terminal_vocab, beam_size,
+                         query_batch, vocab_shortlist, log=False, early_stop=False):
+        """
+        expand the beams of the live examples at time step `t`
+        """
+        hyp_inputs, node_id, is_value = self.get_beam_inputs(t, [jobs[i] for i in live_job_ids], live_job_ids)
+
+        step_outputs = self.decoder_step(t, grammar, hyp_inputs, query_batch, node_id, is_value,
+                                         vocab_shortlist=vocab_shortlist)
+        decoder_next_state, decoder_next_cell, decoder_next_hist_h_att_trans, \
+        rule_prob, gen_action_prob, vocab_prob, copy_prob = step_outputs
+
+        # expand the beam of each example using its own rows of the step outputs
+        hyp_offset = 0
+        for i in live_job_ids:
+            job = jobs[i]
+            rows = slice(hyp_offset, hyp_offset + len(job.beam))
+            hyp_offset += len(job.beam)
+
+            self.expand_beam(job, t, grammar, terminal_vocab, beam_size,
+                             decoder_next_state[rows], decoder_next_cell[rows],
+                             rule_prob[rows], gen_action_prob[rows], vocab_prob[rows], copy_prob[rows],
+                             decoder_next_hist_h_att_trans[rows] if config.tree_attention else None,
+                             log=log, early_stop=early_stop)
+
+    def greedy_search_step(self, jobs, live_job_ids, t, grammar, terminal_vocab,
+                           query_batch, vocab_shortlist, log=False):
+        """
+        greedy decoding at time step `t`, the same as beam search with `beam_size=1`.
+        the single hypothesis of each live example is updated in place with the most
+        probable action, skipping the ranking of candidates and the beam lattice
+        """
+        vocab_embedding = self.vocab_embedding_W.get_value(borrow=True)
+        rule_embedding = self.rule_embedding_W.get_value(borrow=True)
+        all_rule_ids = np.arange(len(grammar), dtype='int32')
+        unk = terminal_vocab.unk
+
+        hyp_inputs, node_id, is_value = self.get_beam_inputs(t, [jobs[i] for i in live_job_ids], live_job_ids)
 
-        outputs = [decoder_next_state, decoder_next_cell,
-                   rule_prob, gen_action_prob, vocab_prob, copy_prob]
+        step_outputs = self.decoder_step(t, grammar, hyp_inputs, query_batch, node_id, is_value,
+                                         vocab_shortlist=vocab_shortlist)
+        decoder_next_state, decoder_next_cell, decoder_next_hist_h_att_trans, \
+        rule_prob, gen_action_prob, vocab_prob, copy_prob = step_outputs
 
-        self.decoder_func_next_step = theano.function(inputs, outputs)
+        for row, i in enumerate(live_job_ids):
+            job = jobs[i]
+            hyp = job.hyp_samples[0]
+            frontier_nt = hyp.frontier_nt()
 
-    def decode(self, example, grammar, terminal_vocab, beam_size, max_time_step, log=False):
-        # beam search decoding
+            if not frontier_nt.is_value:
+                rule_ids = grammar.lhs_rule_ids[frontier_nt.type_id] if config.head_nt_constraint else all_rule_ids
+                rule_id = rule_ids[rule_prob[row, rule_ids].argmax()]
+                action_prob = rule_prob[row, rule_id]
 
-        eos = 1
-        unk = terminal_vocab.unk
-        vocab_embedding = self.vocab_embedding_W.get_value(borrow=True)
-        rule_embedding = self.rule_embedding_W.get_value(borrow=True)
+                rule = grammar.id_to_rule[rule_id]
+                hyp.apply_rule(rule, rule_id, parent_h=decoder_next_state[row])
+                hyp.actions.append(rule)
 
-        query_tokens = example.data[0]
+                action_embed = rule_embedding[rule_id]
+            else:
+                word_prob, cand_copy_probs, unk_words = self.get_word_prob(job, grammar, terminal_vocab,
+                                                                           [row], [frontier_nt.type_id],
+                                                                           gen_action_prob, vocab_prob, copy_prob)
+                tid = word_prob[0].argmax()
+                action_prob = word_prob[0, tid]
+
+                # no token is allowed
+                if action_prob == 0:
+                    job.finished = True
+                    continue
+
+                token = unk_words[0] if tid == unk else terminal_vocab.id_token_map[tid]
+                hyp.append_token(token)
+                hyp.actions.append(token)
+
+                if log and cand_copy_probs[0] > 0.5:
+                    hyp.log += ' || ' + hyp.frontier_nt_repr() + '{copy[%s][p=%f]}' % (token, cand_copy_probs[0])
+
+                action_embed = vocab_embedding[tid]
+
+            score = job.beam.score[0] + np.log(action_prob)
+
+            new_frontier_nt = hyp.frontier_nt()
+            if new_frontier_nt is None:
+                hyp.score = score
+                hyp.n_timestep = t + 1
+                job.completed_hyps.append(hyp)
+                job.completed_hyp_num += 1
+                job.finished = True
+            else:
+                rows = slice(row, row + 1)
+                job.beam.update([0], [score], decoder_next_state[rows], decoder_next_cell[rows],
+                                decoder_next_hist_h_att_trans[rows] if config.tree_attention else None)
+                job.beam.action_embed[0] = action_embed
+                job.beam.set_frontier(0, new_frontier_nt)
+
+    def start_budgets(self, budgets):
+        for budget in budgets or []:
+            if budget is not None:
+                budget.start()
+
+    def spend_budgets(self, jobs, budgets):
+        """
+        charge the hypothesis expansions of the next decoder step to the budget of
+        each live example, and stop the search of those whose budget is exhausted
+        """
+        for job, budget in zip(jobs, budgets):
+            if job.finished or budget is None:
+                continue
+
+            status = budget.spend(len(job.beam))
+            if status is not None:
+                job.finished = True
+                budget.finish(status)
+
+    def encode_queries(self, jobs):
+        """
+        encode the queries of the jobs, and pad the query-only terms of the decoder to
+        the same length. hypotheses look up their query by index in the decoder step functions
+        """
+
+        query_num = len(jobs)
+        query_encodings = [self.decoder_func_init(job.example.data[0]) for job in jobs]
+        max_query_length = max(enc[1].shape[1] for enc in query_encodings)
+
+        query_batch = []
+        for i, item in enumerate(query_encodings[0]):
+            item_batch = np.zeros((query_num, max_query_length) + item.shape[2:], dtype=item.dtype)
+            for qid, enc in enumerate(query_encodings):
+                item_batch[qid, :enc[i].shape[1]] = enc[i][0]
+            query_batch.append(item_batch)
+
+        return query_batch
+
+    def get_beam_inputs(self, t, jobs, query_ids):
+        """
+        stack the decoder inputs of the live hypotheses of the jobs at time step `t`, where
+        `query_ids` are the indices of their queries. also return the node type id of the
+        frontier node of each hypothesis, and whether it is a value node
+        """
+
+        beams = [job.beam for job in jobs]
+        hyp_num = sum(beam.hyp_num for beam in beams)
+
+        # print 'time step [%d]' % t
+        decoder_prev_state = np.concatenate([beam.state[:beam.hyp_num] for beam in beams])
+        decoder_prev_cell = np.concatenate([beam.cell[:beam.hyp_num] for beam in beams])
+
+        prev_action_embed = np.concatenate([beam.action_embed[:beam.hyp_num] for beam in beams])
+        node_id = np.concatenate([beam.node_id[:beam.hyp_num] for beam in beams])
+        parent_rule_id = np.concatenate([beam.parent_rule_id[:beam.hyp_num] for beam in beams])
+        parent_t = np.concatenate([beam.parent_t[:beam.hyp_num] for beam in beams])
+
+        if config.tree_attention:
+            # the first t hidden states of each hypothesis and their cached projections.
+            # at the first step there is no history, and a dummy one is used
+            if t > 0:
+                hist_h = np.concatenate([beam.hist_h for beam in beams]).astype('float32')
+                hist_h_att_trans = np.concatenate([beam.hist_h_att_trans for beam in beams]).astype('float32')
+            else:
+                hist_h = np.zeros((hyp_num, 1, config.decoder_hidden_dim)).astype('float32')
+                hist_h_att_trans = np.zeros((hyp_num, 1, config.attention_hidden_dim)).astype('float32')
 
-        query_embed, query_token_embed_mask = self.decoder_func_init(query_tokens)
+            hist_inputs = [hist_h, hist_h_att_trans, parent_t]
+        else:
+            # only the hidden state of the parent action of each hypothesis
+            parent_h = np.concatenate([beam.parent_h[:beam.hyp_num] for beam in beams])
 
-        completed_hyps = []
-        completed_hyp_num = 0
-        live_hyp_num = 1
+            hist_inputs = [parent_h]
 
-        root_hyp = Hyp(grammar)
-        root_hyp.state = np.zeros(config.decoder_hidden_dim).astype('float32')
-        root_hyp.cell = np.zeros(config.decoder_hidden_dim).astype('float32')
-        root_hyp.action_embed = np.zeros(config.rule_embed_dim).astype('float32')
-        root_hyp.node_id = grammar.get_node_type_id(root_hyp.tree.type)
-        root_hyp.parent_rule_id = -1
+        hyp_query_id = np.concatenate([np.repeat(query_id, beam.hyp_num)
+                                       for query_id, beam in zip(query_ids, beams)]).astype('int32')
 
-        hyp_samples = [root_hyp]  # [list() for i in range(live_hyp_num)]
+        hyp_inputs = [decoder_prev_state, decoder_prev_cell, prev_action_embed,
+                      node_id, parent_rule_id] + hist_inputs + [hyp_query_id]
 
-        # source word id in the terminal vocab
-        src_token_id = [terminal_vocab[t] for t in example.query][:config.max_query_length]
-        unk_pos_list = [x for x, t in enumerate(src_token_id) if t == unk]
+        is_value = np.concatenate([beam.is_value[:beam.hyp_num] for beam in beams])
 
-        # sometimes a word may appear multi-times in the source, in this case,
-        # we just copy its first appearing position. Therefore we mask the words
-        # appearing second and onwards to -1
-        token_set = set()
-        for i, tid in enumerate(src_token_id):
-            if tid in token_set:
-                src_token_id[i] = -1
-            else: token_set.add(tid)
+        return hyp_inputs, node_id, is_value
 
-        for t in xrange(max_time_step):
-            hyp_num = len(hyp_samples)
-            # print 'time step [%d]' % t
-            decoder_prev_state = np.array([hyp.state for hyp in hyp_samples]).astype('float32')
-            decoder_prev_cell = np.array([hyp.cell for hyp in hyp_samples]).astype('float32')
+    def get_vocab_shortlist(self, jobs, terminal_vocab):
+        """
+        the candidate terminal ids of the token head for the query of each job: the
+        `config.vocab_shortlist_size` most frequent terminals, the literals of constants
+        and numbers, the copyable source tokens, unk and eos. return the shortlists padded
+        into a matrix, (query_num, max_shortlist_size), and the mask of the padding
+        """
 
-            hist_h = np.zeros((hyp_num, max_time_step, config.decoder_hidden_dim)).astype('float32')
+        if self.terminal_token_freq is not None:
+            token_freq = self.terminal_token_freq
+        else:
+            # without the training set, the bias of the token head is a proxy of the frequency
+            token_freq = self.vocab_embedding_b.get_value(borrow=True)
+
+        frequent_token_ids = np.argsort(-token_freq, kind='mergesort')[:config.vocab_shortlist_size]
+        literal_token_ids = [tid for token, tid in terminal_vocab.iteritems()
+                             if token in ('True', 'False', 'None') or (token and is_numeric(token))]
+        common_token_ids = np.concatenate([frequent_token_ids, literal_token_ids,
+                                           [terminal_vocab.unk, terminal_vocab.eos]]).astype('int32')
+
+        shortlists = [np.union1d(common_token_ids, job.copy_token_id) for job in jobs]
+        max_shortlist_size = max(len(shortlist) for shortlist in shortlists)
+
+        vocab_shortlist = np.zeros((len(jobs), max_shortlist_size), dtype='int32')
+        vocab_shortlist_mask = np.zeros((len(jobs), max_shortlist_size), dtype='float32')
+        for i, shortlist in enumerate(shortlists):
+            vocab_shortlist[i, :len(shortlist)] = shortlist
+            vocab_shortlist_mask[i, :len(shortlist)] = 1.
+
+        return vocab_shortlist, vocab_shortlist_mask
+
+    def decoder_step(self, t, grammar, hyp_inputs, query_batch, node_id, is_value, vocab_shortlist=None):
+        """
+        run the decoder for one time step. hypotheses at value nodes only need the token
+        and copy heads, and the others only the rule head, so the two groups are fed to
+        their own step functions, and the outputs are scattered back to the rows of the
+        hypotheses. the rows of a head that are not computed are zeros.
+        with `config.restricted_rule_softmax`, the rule head only scores the legal rules
+        of the frontier node, and is normalized over them. Likewise with `vocab_shortlist`,
+        the token head only scores the shortlist of the query
+        """
+
+        hyp_num = len(is_value)
+        query_length = query_batch[0].shape[1]
+        state_output_num = 3 if config.tree_attention else 2
+
+        state_outputs = [None] * state_output_num
+        rule_prob = np.zeros((hyp_num, config.rule_num), dtype='float32')
+        gen_action_prob = np.zeros((hyp_num, 2), dtype='float32')
+        vocab_prob = np.zeros((hyp_num, config.target_vocab_size), dtype='float32')
+        copy_prob = np.zeros((hyp_num, query_length), dtype='float32')
+
+        def run_step_func(step_func, hyp_ids, extra_inputs=[]):
+            # `hyp_query_id` is the last input
+            group_inputs = [x[hyp_ids] for x in hyp_inputs]
+            group_outputs = step_func(np.array([t], dtype='int32'),
+                                      *(group_inputs[:-1] + query_batch + group_inputs[-1:] + extra_inputs))
+
+            for i, group_x in enumerate(group_outputs[:state_output_num]):
+                if state_outputs[i] is None:
+                    state_outputs[i] = np.zeros((hyp_num, ) + group_x.shape[1:], dtype=group_x.dtype)
+                state_outputs[i][hyp_ids] = group_x
+
+            return group_outputs[state_output_num:]
+
+        rule_hyp_ids = np.flatnonzero(~is_value)
+        if len(rule_hyp_ids) > 0:
+            if config.restricted_rule_softmax:
+                legal_rule_ids = grammar.lhs_rule_id_table[node_id[rule_hyp_ids]]
+                legal_rule_mask = grammar.lhs_rule_id_table_mask[node_id[rule_hyp_ids]]
+
+                legal_rule_prob, = run_step_func(self.decoder_func_next_step_legal_rule, rule_hyp_ids,
+                                                 [legal_rule_ids, legal_rule_mask])
+
+                rows, cols = np.nonzero(legal_rule_mask)
+                rule_prob[rule_hyp_ids[rows], legal_rule_ids[rows, cols]] = legal_rule_prob[rows, cols]
+            else:
+                rule_prob[rule_hyp_ids], = run_step_func(self.decoder_func_next_step_rule, rule_hyp_ids)
 
-            if t > 0:
-                for i, hyp in enumerate(hyp_samples):
-                    hist_h[i, :len(hyp.hist_h), :] = hyp.hist_h
-                    # for j, h in enumerate(hyp.hist_h):
-                    #    hist_h[i, j] = h
+        token_hyp_ids = np.flatnonzero(is_value)
+        if len(token_hyp_ids) > 0:
+            if vocab_shortlist is not None:
+                gen_action_prob[token_hyp_ids], shortlist_vocab_prob, copy_prob[token_hyp_ids] = \
+                    run_step_func(self.decoder_func_next_step_shortlist_token, token_hyp_ids, list(vocab_shortlist))
 
-            prev_action_embed = np.array([hyp.action_embed for hyp in hyp_samples]).astype('float32')
-            node_id = np.array([hyp.node_id for hyp in hyp_samples], dtype='int32')
-            parent_rule_id = np.array([hyp.parent_rule_id for hyp in hyp_samples], dtype='int32')
-            parent_t = np.array([hyp.get_action_parent_t() for hyp in hyp_samples], dtype='int32')
-            query_embed_tiled = np.tile(query_embed, [live_hyp_num, 1, 1])
-            query_token_embed_mask_tiled = np.tile(query_token_embed_mask, [live_hyp_num, 1])
+                # `hyp_query_id` is the last input
+                hyp_query_id = hyp_inputs[-1][token_hyp_ids]
+                shortlist_token_ids = vocab_shortlist[0][hyp_query_id]
 
-            inputs = [np.array([t], dtype='int32'), decoder_prev_state, decoder_prev_cell, hist_h, prev_action_embed,
-                      node_id, parent_rule_id, parent_t,
-                      query_embed_tiled, query_token_embed_mask_tiled]
+                rows, cols = np.nonzero(vocab_shortlist[1][hyp_query_id])
+                vocab_prob[token_hyp_ids[rows], shortlist_token_ids[rows, cols]] = shortlist_vocab_prob[rows, cols]
+            else:
+                gen_action_prob[token_hyp_ids], vocab_prob[token_hyp_ids], copy_prob[token_hyp_ids] = \
+                    run_step_func(self.decoder_func_next_step_token, token_hyp_ids)
 
-            decoder_next_state, decoder_next_cell, \
-            rule_prob, gen_action_prob, vocab_prob, copy_prob  = self.decoder_func_next_step(*inputs)
+        if not config.tree_attention:
+            state_outputs.append(None)
 
-            new_hyp_samples = []
+        return state_outputs + [rule_prob, gen_action_prob, vocab_prob, copy_prob]
 
-            cut_off_k = beam_size
-            score_heap = []
+    def get_word_prob(self, job, grammar, terminal_vocab, word_gen_hyp_ids, word_gen_type_ids,
+                      gen_action_prob, vocab_prob, copy_prob):
+        """
+        the token probabilities of the hypotheses at value nodes of one example, (word_gen_hyp_num, vocab_size),
+        including the copy probabilities. also return the copy probability of each hypothesis
+        for decode logs, and the source word copied by the unk token of each hypothesis
+        """
 
-            # iterating over items in the beam
-            # print 'time step: %d, hyp num: %d' % (t, live_hyp_num)
+        unk = terminal_vocab.unk
+        unk_pos_list = job.unk_pos_list
+
+        # the token heads are only computed for these hypotheses
+        word_gen_hyp_id_array = np.array(word_gen_hyp_ids, dtype='int32')
+        word_prob = gen_action_prob[word_gen_hyp_id_array, 0:1] * vocab_prob[word_gen_hyp_id_array]
+        word_prob[:, unk] = 0
+
+        # add the copy probabilities of the source tokens.
+        # each terminal id appears at most once in `copy_token_id`
+        word_gen_rows = np.arange(len(word_gen_hyp_ids))
+        copy_gen_prob = gen_action_prob[word_gen_hyp_id_array, 1]
+        unk_words = []
+
+        if len(job.copy_src_pos) > 0:
+            np.add.at(word_prob, (word_gen_rows[:, None], job.copy_token_id[None, :]),
+                      copy_gen_prob[:, None] * copy_prob[word_gen_hyp_id_array[:, None], job.copy_src_pos[None, :]])
+
+        # and unk copy probability
+        if len(unk_pos_list) > 0:
+            unk_copy_prob = copy_prob[word_gen_hyp_id_array[:, None], job.unk_pos[None, :]]
+            unk_pos = job.unk_pos[unk_copy_prob.argmax(axis=1)]
+
+            word_prob[word_gen_rows, unk] = copy_gen_prob * copy_prob[word_gen_hyp_id_array, unk_pos]
+            unk_words = [job.example.query[pos] for pos in unk_pos]
+
+        # rule out the tokens that cannot appear in the values of the frontier node types
+        if config.value_token_type_mask and word_gen_hyp_ids:
+            value_token_masks = grammar.get_value_token_masks(terminal_vocab)
+            if value_token_masks is not None:
+                word_prob[~value_token_masks[word_gen_type_ids]] = 0
+
+        if len(job.copy_src_pos) > 0 or len(unk_pos_list) > 0:
+            cand_copy_probs = copy_gen_prob
+        else:
+            cand_copy_probs = np.zeros(len(word_gen_hyp_ids))
 
-            word_prob = gen_action_prob[:, 0:1] * vocab_prob
-            word_prob[:, unk] = 0
+        return word_prob, cand_copy_probs, unk_words
 
-            hyp_scores = np.array([hyp.score for hyp in hyp_samples])
+    def expand_beam(self, job, t, grammar, terminal_vocab, beam_size,
+                    decoder_next_state, decoder_next_cell,
+                    rule_prob, gen_action_prob, vocab_prob, copy_prob,
+                    decoder_next_hist_h_att_trans=None, log=False, early_stop=False):
+        """
+        score the candidate actions of the live hypotheses of one example at time step `t`,
+        and update its beam in place with the top candidates
+        """
 
-            # word_prob[:, src_token_id] += gen_action_prob[:, 1:2] * copy_prob[:, :len(src_token_id)]
-            # word_prob[:, unk] = 0
+        eos = 1
+        unk = terminal_vocab.unk
+        vocab_embedding = self.vocab_embedding_W.get_value(borrow=True)
+        rule_embedding = self.rule_embedding_W.get_value(borrow=True)
 
-            rule_apply_cand_hyp_ids = []
-            rule_apply_cand_scores = []
-            rule_apply_cand_rules = []
-            rule_apply_cand_rule_ids = []
+        example = job.example
+        hyp_samples = job.hyp_samples
+        live_hyp_num = len(hyp_samples)
+        unk_pos_list = job.unk_pos_list
 
-            hyp_frontier_nts = []
-            word_gen_hyp_ids = []
-            cand_copy_probs = []
-            unk_words = []
+        new_hyp_samples = []
 
-            for k in xrange(live_hyp_num):
-                hyp = hyp_samples[k]
+        cut_off_k = beam_size
+        score_heap = []
 
-                # if k == 0:
-                #     print 'Top Hyp: %s' % hyp.tree.__repr__()
+        # iterating over items in the beam
+        # print 'time step: %d, hyp num: %d' % (t, live_hyp_num)
 
-                frontier_nt = hyp.frontier_nt()
-                hyp_frontier_nts.append(frontier_nt)
+        hyp_scores = job.beam.score[:live_hyp_num]
+        all_rule_ids = np.arange(len(grammar), dtype='int32')
 
-                assert hyp, 'none hyp!'
+        # word_prob[:, src_token_id] += gen_action_prob[:, 1:2] * copy_prob[:, :len(src_token_id)]
+        # word_prob[:, unk] = 0
 
-                # if it's not a leaf
-                if not grammar.is_value_node(frontier_nt):
-                    # iterate over all the possible rules
-                    rules = grammar[frontier_nt.as_type_node] if config.head_nt_constraint else grammar
-                    assert len(rules) > 0, 'fail to expand nt node %s' % frontier_nt
-                    for rule in rules:
-                        rule_id = grammar.rule_to_id[rule]
+        # the ids of the hypotheses to expand with rules, and the candidate rule ids of each
+        rule_apply_hyp_ids = []
+        rule_apply_rule_ids = []
 
-                        cur_rule_score = np.log(rule_prob[k, rule_id])
-                        new_hyp_score = hyp.score + cur_rule_score
+        hyp_frontier_nts = []
+        word_gen_hyp_ids = []
 
-                        rule_apply_cand_hyp_ids.append(k)
-                        rule_apply_cand_scores.append(new_hyp_score)
-                        rule_apply_cand_rules.append(rule)
-                        rule_apply_cand_rule_ids.append(rule_id)
+        for k in xrange(live_hyp_num):
+            hyp = hyp_samples[k]
 
-                else:  # it's a leaf that holds values
-                    cand_copy_prob = 0.0
-                    for i, tid in enumerate(src_token_id):
-                        if tid != -1:
-                            word_prob[k, tid] += gen_action_prob[k, 1] * copy_prob[k, i]
-                            cand_copy_prob = gen_action_prob[k, 1]
+            # if k == 0:
+            #     print 'Top Hyp: %s' % hyp.tree.__repr__()
 
-                    # and unk copy probability
-                    if len(unk_pos_list) > 0:
-                        unk_pos = copy_prob[k, unk_pos_list].argmax()
-                        unk_pos = unk_pos_list[unk_pos]
+            frontier_nt = hyp.frontier_nt()
+            hyp_frontier_nts.append(frontier_nt)
 
-                        unk_copy_score = gen_action_prob[k, 1] * copy_prob[k, unk_pos]
-                        word_prob[k, unk] = unk_copy_score
+            assert hyp, 'none hyp!'
 
-                        unk_word = example.query[unk_pos]
-                        unk_words.append(unk_word)
+            # if it's not a leaf
+            if not frontier_nt.is_value:
+                # all the possible rules
+                rule_ids = grammar.lhs_rule_ids[frontier_nt.type_id] if config.head_nt_constraint else all_rule_ids
+                assert len(rule_ids) > 0, 'fail to expand nt node %s' % frontier_nt.type
 
-                        cand_copy_prob = gen_action_prob[k, 1]
+                rule_apply_hyp_ids.append(np.repeat(k, len(rule_ids)))
+                rule_apply_rule_ids.append(rule_ids)
 
-                    word_gen_hyp_ids.append(k)
-                    cand_copy_probs.append(cand_copy_prob)
+            else:  # it's a leaf that holds values
+                word_gen_hyp_ids.append(k)
 
-            # prune the hyp space
-            if completed_hyp_num >= beam_size:
-                break
+        word_gen_type_ids = [hyp_frontier_nts[k].type_id for k in word_gen_hyp_ids]
+        word_prob, cand_copy_probs, unk_words = self.get_word_prob(job, grammar, terminal_vocab, word_gen_hyp_ids,
+                                                                   word_gen_type_ids, gen_action_prob,
+                                                                   vocab_prob, copy_prob)
 
-            word_prob = np.log(word_prob)
+        # prune the hyp space
+        if job.completed_hyp_num >= beam_size:
+            job.finished = True
+            return
 
-            word_gen_hyp_num = len(word_gen_hyp_ids)
-            rule_apply_cand_num = len(rule_apply_cand_scores)
+        word_prob = np.log(word_prob)
 
-            if word_gen_hyp_num > 0:
-                word_gen_cand_scores = hyp_scores[word_gen_hyp_ids, None] + word_prob[word_gen_hyp_ids, :]
-                word_gen_cand_scores_flat = word_gen_cand_scores.flatten()
+        # score all the rule applications with a single gather
+        if rule_apply_hyp_ids:
+            rule_apply_cand_hyp_ids = np.concatenate(rule_apply_hyp_ids)
+            rule_apply_cand_rule_ids = np.concatenate(rule_apply_rule_ids)
+            rule_apply_cand_scores = hyp_scores[rule_apply_cand_hyp_ids] + \
+                                     np.log(rule_prob[rule_apply_cand_hyp_ids, rule_apply_cand_rule_ids])
+        else:
+            rule_apply_cand_scores = np.zeros(0)
+
+        word_gen_hyp_num = len(word_gen_hyp_ids)
+        rule_apply_cand_num = len(rule_apply_cand_scores)
+        top_k = beam_size - job.completed_hyp_num
+
+        # candidates are numbered as all the rule applications followed by the flattened
+        # (word_gen_hyp_num, vocab_size) word generations. Only the top k words of each
+        # hypothesis (with ties) can make it into the global top k, so the others are
+        # pruned before selecting the global top k. Words with zero probability, e.g.
+        # those out of the vocab shortlist, are never candidates
+        if word_gen_hyp_num > 0:
+            word_gen_cand_scores = hyp_scores[word_gen_hyp_ids, None] + word_prob
+
+            vocab_size = word_gen_cand_scores.shape[1]
+            if top_k < vocab_size:
+                thresholds = np.partition(word_gen_cand_scores, vocab_size - top_k, axis=1)[:, vocab_size - top_k]
+                word_gen_cand_ids = np.flatnonzero((word_gen_cand_scores >= thresholds[:, None]) &
+                                                   (word_gen_cand_scores > -np.inf))
+            else:
+                word_gen_cand_ids = np.flatnonzero(word_gen_cand_scores > -np.inf)
 
-                cand_scores = np.concatenate([rule_apply_cand_scores, word_gen_cand_scores_flat])
+            cand_ids = np.concatenate([np.arange(rule_apply_cand_num), rule_apply_cand_num + word_gen_cand_ids])
+            cand_scores = np.concatenate([rule_apply_cand_scores, word_gen_cand_scores.flat[word_gen_cand_ids]])
+        else:
+            cand_ids = np.arange(rule_apply_cand_num)
+            cand_scores = np.array(rule_apply_cand_scores)
+
+        # the candidate ids are increasing, so ties are still broken by the lower candidate id
+        top_cand_ids = cand_ids[top_k_ids(cand_scores, top_k)]
+
+        # relative threshold pruning: the new live hypotheses scoring lower than the best
+        # candidate by more than `config.beam_prune_threshold` are dropped, which shrinks
+        # the beam when the best candidate stands out
+        prune_score = -np.inf
+        if config.beam_prune_threshold > 0 and len(cand_scores) > 0:
+            prune_score = cand_scores.max() - config.beam_prune_threshold
+
+        # the expanded candidates are recorded in the beam lattice, only the
+        # live hypotheses keep their frontier, and the completed ones are
+        # recovered from the lattice afterwards
+        lattice_backpointers = []
+        lattice_rule_ids = []
+        lattice_tokens = []
+        lattice_scores = []
+        lattice_copy_probs = []
+
+        new_hyp_parent_ids = []
+        new_hyp_scores = []
+        new_hyp_rule_ids = []
+        new_hyp_token_ids = []
+        completed_lattice_ids = []
+
+        # expand_cand_num = 0
+        for cand_id in top_cand_ids:
+            # cand is rule application
+            new_hyp = None
+            if cand_id < rule_apply_cand_num:
+                hyp_id = rule_apply_cand_hyp_ids[cand_id]
+                hyp = hyp_samples[hyp_id]
+                rule_id = rule_apply_cand_rule_ids[cand_id]
+                rule = grammar.id_to_rule[rule_id]
+                new_hyp_score = rule_apply_cand_scores[cand_id]
+
+                new_hyp = Hyp(hyp)
+                new_hyp.apply_rule(rule, rule_id, parent_h=decoder_next_state[hyp_id])
+
+                token = None
+                tid = -1
+                cand_copy_prob = 0.0
             else:
-                cand_scores = np.array(rule_apply_cand_scores)
-
-            top_cand_ids = (-cand_scores).argsort()[:beam_size - completed_hyp_num]
-
-            # expand_cand_num = 0
-            for cand_id in top_cand_ids:
-                # cand is rule application
-                new_hyp = None
-                if cand_id < rule_apply_cand_num:
-                    hyp_id = rule_apply_cand_hyp_ids[cand_id]
-                    hyp = hyp_samples[hyp_id]
-                    rule_id = rule_apply_cand_rule_ids[cand_id]
-                    rule = rule_apply_cand_rules[cand_id]
-                    new_hyp_score = rule_apply_cand_scores[cand_id]
-
-                    new_hyp = Hyp(hyp)
-                    new_hyp.apply_rule(rule)
-
-                    new_hyp.score = new_hyp_score
-                    new_hyp.state = copy.copy(decoder_next_state[hyp_id])
-                    new_hyp.hist_h.append(copy.copy(new_hyp.state))
-                    new_hyp.cell = copy.copy(decoder_next_cell[hyp_id])
-                    new_hyp.action_embed = rule_embedding[rule_id]
+                rule_id = -1
+                tid = (cand_id - rule_apply_cand_num) % word_prob.shape[1]
+                word_gen_hyp_id = (cand_id - rule_apply_cand_num) / word_prob.shape[1]
+                hyp_id = word_gen_hyp_ids[word_gen_hyp_id]
+
+                if tid == unk:
+                    token = unk_words[word_gen_hyp_id]
                 else:
-                    tid = (cand_id - rule_apply_cand_num) % word_prob.shape[1]
-                    word_gen_hyp_id = (cand_id - rule_apply_cand_num) / word_prob.shape[1]
-                    hyp_id = word_gen_hyp_ids[word_gen_hyp_id]
+                    token = terminal_vocab.id_token_map[tid]
 
-                    if tid == unk:
-                        token = unk_words[word_gen_hyp_id]
-                    else:
-                        token = terminal_vocab.id_token_map[tid]
+                frontier_nt = hyp_frontier_nts[hyp_id]
 
-                    frontier_nt = hyp_frontier_nts[hyp_id]
-                    # if frontier_nt.type == int and (not (is_numeric(token) or token == '<eos>')):
-                    #     continue
+                hyp = hyp_samples[hyp_id]
+                new_hyp_score = word_gen_cand_scores[word_gen_hyp_id, tid]
 
-                    hyp = hyp_samples[hyp_id]
-                    new_hyp_score = word_gen_cand_scores[word_gen_hyp_id, tid]
+                new_hyp = Hyp(hyp)
+                new_hyp.append_token(token)
 
-                    new_hyp = Hyp(hyp)
-                    new_hyp.append_token(token)
+                cand_copy_prob = cand_copy_probs[word_gen_hyp_id]
 
-                    if log:
-                        cand_copy_prob = cand_copy_probs[word_gen_hyp_id]
-                        if cand_copy_prob > 0.5:
-                            new_hyp.log += ' || ' + str(new_hyp.frontier_nt()) + '{copy[%s][p=%f]}' % (token ,cand_copy_prob)
+            new_hyp.lattice_id = len(lattice_backpointers)
+            lattice_backpointers.append(hyp.lattice_id)
+            lattice_rule_ids.append(rule_id)
+            lattice_tokens.append(token)
+            lattice_scores.append(new_hyp_score)
+            lattice_copy_probs.append(cand_copy_prob)
 
-                    new_hyp.score = new_hyp_score
-                    new_hyp.state = copy.copy(decoder_next_state[hyp_id])
-                    new_hyp.hist_h.append(copy.copy(new_hyp.state))
-                    new_hyp.cell = copy.copy(decoder_next_cell[hyp_id])
-                    new_hyp.action_embed = vocab_embedding[tid]
-                    new_hyp.node_id = grammar.get_node_type_id(frontier_nt)
+            # get the new frontier nt after rule application
+            new_frontier_nt = new_hyp.frontier_nt()
 
+            # if new_frontier_nt is None, then we have a new completed hyp!
+            if new_frontier_nt is None:
+                # if t <= 1:
+                #     continue
 
-                # get the new frontier nt after rule application
-                new_frontier_nt = new_hyp.frontier_nt()
+                completed_lattice_ids.append(new_hyp.lattice_id)
+                job.completed_hyp_num += 1
 
-                # if new_frontier_nt is None, then we have a new completed hyp!
-                if new_frontier_nt is None:
-                    # if t <= 1:
-                    #     continue
+            elif new_hyp_score >= prune_score:
+                new_hyp_samples.append(new_hyp)
+                new_hyp_parent_ids.append(hyp_id)
+                new_hyp_scores.append(new_hyp_score)
+                new_hyp_rule_ids.append(rule_id)
+                new_hyp_token_ids.append(tid)
 
-                    new_hyp.n_timestep = t + 1
-                    completed_hyps.append(new_hyp)
-                    completed_hyp_num += 1
+            # expand_cand_num += 1
+            # if expand_cand_num >= beam_size - completed_hyp_num:
+            #     break
 
-                else:
-                    new_hyp.node_id = grammar.get_node_type_id(new_frontier_nt.type)
-                    # new_hyp.parent_rule_id = grammar.rule_to_id[
-                    #     new_frontier_nt.parent.to_rule(include_value=False)]
-                    new_hyp.parent_rule_id = grammar.rule_to_id[new_frontier_nt.parent.applied_rule]
+            # cand is word generation
 
-                    new_hyp_samples.append(new_hyp)
+        job.add_lattice_step(lattice_backpointers, lattice_rule_ids, lattice_tokens,
+                             lattice_scores, lattice_copy_probs)
 
-                # expand_cand_num += 1
-                # if expand_cand_num >= beam_size - completed_hyp_num:
-                #     break
+        for lattice_id in completed_lattice_ids:
+            job.completed_hyps.append(job.get_hyp(t, lattice_id, log=log))
 
-                # cand is word generation
+        live_hyp_num = min(len(new_hyp_samples), beam_size - job.completed_hyp_num)
+        if live_hyp_num < 1:
+            job.finished = True
+            return
 
-            live_hyp_num = min(len(new_hyp_samples), beam_size - completed_hyp_num)
-            if live_hyp_num < 1:
-                break
+        # log probabilities only decrease, so no live hypothesis can beat the best
+        # completed one any more. ties are fine as the sort of completed hypotheses is stable
+        if early_stop and job.completed_hyps and \
+                max(hyp.score for hyp in job.completed_hyps) >= max(new_hyp_scores):
+            job.finished = True
+            return
 
-            hyp_samples = new_hyp_samples
-            # hyp_samples = sorted(new_hyp_samples, key=lambda x: x.score, reverse=True)[:live_hyp_num]
+        job.hyp_samples = new_hyp_samples
+        # hyp_samples = sorted(new_hyp_samples, key=lambda x: x.score, reverse=True)[:live_hyp_num]
 
-        completed_hyps = sorted(completed_hyps, key=lambda x: x.score, reverse=True)
+        # reorder the decoder inputs of the beam with the new live hypotheses
+        beam = job.beam
+        beam.update(new_hyp_parent_ids, new_hyp_scores, decoder_next_state, decoder_next_cell,
+                    decoder_next_hist_h_att_trans)
 
-        return completed_hyps
+        new_hyp_rule_ids = np.array(new_hyp_rule_ids)
+        new_hyp_token_ids = np.array(new_hyp_token_ids)
+        is_rule = new_hyp_rule_ids >= 0
+        beam.action_embed[:beam.hyp_num][is_rule] = rule_embedding[new_hyp_rule_ids[is_rule]]
+        beam.action_embed[:beam.hyp_num][~is_rule] = vocab_embedding[new_hyp_token_ids[~is_rule]]
+
+        for i, new_hyp in enumerate(new_hyp_samples):
+            beam.set_frontier(i, new_hyp.frontier_nt())
 
     @property
     def params_name_to_id(self):
@@ -599,9 +1283,28 @@ class Model:
 
         np.savez(model_file, **weights_dict)
 
-    def load(self, model_file):
+    def save_npy(self, weights_dir):
+        """
+        save the weights as an uncompressed .npy file per parameter in `weights_dir`,
+        which `load` can memory-map
+        """
+        logging.info('save model to [%s]', weights_dir)
+
+        save_npy_dir(self.pull_params(), weights_dir)
+
+    def load(self, model_file, mmap_mode=None):
+        """
+        load the weights from an npz file saved by `save`, or a directory saved by `save_npy`.
+        with `mmap_mode` (e.g. 'r') the .npy files of a directory are memory-mapped and used
+        by the parameters without a copy, so that the processes decoding with the same weights
+        on a host share them in the page cache. Only use it for decoding, as the weights
+        are read-only
+        """
         logging.info('load model from [%s]', model_file)
-        weights_dict = np.load(model_file)
+        if os.path.isdir(model_file):
+            weights_dict = load_npy_dir(model_file, mmap_mode=mmap_mode)
+        else:
+            weights_dict = np.load(model_file)
 
         # assert len(weights_dict.files) == len(self.params_dict)
 
@@ -610,7 +1313,9 @@ class Model:
                 raise RuntimeError('parameter [%s] not in saved weights file', p_name)
             else:
                 logging.info('loading parameter [%s]', p_name)
-                assert np.array_equal(p.shape.eval(), weights_dict[p_name].shape), \
-                    'shape mis-match for [%s]!, %s != %s' % (p_name, p.shape.eval(), weights_dict[p_name].shape)
+                weights = weights_dict[p_name]
+                p_shape = p.get_value(borrow=True).shape
+                assert p_shape == weights.shape, \
+                    'shape mis-match for [%s]!, %s != %s' % (p_name, p_shape, weights.shape)
 
-                p.set_value(weights_dict[p_name])
+                p.set_value(weights, borrow=isinstance(weights, np.memmap))
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import os
 import cPickle
 import h5py
 import numpy as np
@@ -83,4 +84,29 @@ def deserialize_from_file(path):
     f = open(path, 'rb')
     obj = cPickle.load(f)
     f.close()
-    return obj
\ No newline at end of file
+    return obj
+
+
+def save_npy_dir(arrays, path):
+    """
+    save each array of the dict `arrays` as an uncompressed .npy file named by its key
+    in the directory `path`, so that it can be memory-mapped when loaded
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    for name, array in arrays.iteritems():
+        np.save(os.path.join(path, name + '.npy'), array)
+
+
+def load_npy_dir(path, mmap_mode=None):
+    """
+    load the arrays saved by `save_npy_dir` into a dict, memory-mapped with `mmap_mode`
+    (e.g. 'r') if given, so that processes loading the same files share their pages
+    """
+    arrays = dict()
+    for file_name in os.listdir(path):
+        if file_name.endswith('.npy'):
+            arrays[file_name[:-len('.npy')]] = np.load(os.path.join(path, file_name), mmap_mode=mmap_mode)
+
+    return arrays
@@ -0,0 +1,717 @@
+import argparse
+import sys
+import os
+import time
+import json
+import logging
+import threading
+import socket
+import signal
+import gc
+import Queue
+import traceback
+import BaseHTTPServer
+import SocketServer
+from collections import deque, namedtuple
+
+import numpy as np
+import astor
+
+import config
+from nn.utils.generic_utils import init_logging
+from dataset import canonicalize_query, query_to_data, decanonicalize_code
+from components import DecodeBudget
+from bundle import load_bundle
+
+Example = namedtuple('example', ['query', 'data'])
+
+parser = argparse.ArgumentParser()
+# an inference bundle exported by `code_gen.py export_bundle`
+parser.add_argument('-bundle', required=True)
+parser.add_argument('-func_cache_dir', default=None)
+
+# decoding
+parser.add_argument('-beam_size', default=15, type=int)
+parser.add_argument('-decode_max_time_step', default=100, type=int)
+parser.add_argument('-head_nt_constraint', dest='head_nt_constraint', action='store_true')
+parser.add_argument('-no_head_nt_constraint', dest='head_nt_constraint', action='store_false')
+parser.set_defaults(head_nt_constraint=True)
+
+parser.add_argument('-restricted_rule_softmax', dest='restricted_rule_softmax', action='store_true')
+parser.add_argument('-no_restricted_rule_softmax', dest='restricted_rule_softmax', action='store_false')
+parser.set_defaults(restricted_rule_softmax=False)
+
+parser.add_argument('-value_token_type_mask', dest='value_token_type_mask', action='store_true')
+parser.add_argument('-no_value_token_type_mask', dest='value_token_type_mask', action='store_false')
+parser.set_defaults(value_token_type_mask=True)
+
+parser.add_argument('-vocab_shortlist_size', default=0, type=int)
+
+parser.add_argument('-early_stop', dest='early_stop', action='store_true')
+parser.add_argument('-no_early_stop', dest='early_stop', action='store_false')
+parser.set_defaults(early_stop=False)
+
+parser.add_argument('-beam_prune_threshold', default=0., type=float)
+
+# the default time limit in seconds and max number of hypothesis expansions of a request, 0 for no limit
+parser.add_argument('-decode_timeout', default=0., type=float)
+parser.add_argument('-decode_max_expansion_num', default=0, type=int)
+
+# batching: the max number of requests decoded together, and the time in seconds to wait
+# for more requests after the first one of a batch arrives
+parser.add_argument('-decode_batch_size', default=10, type=int)
+parser.add_argument('-batch_window', default=0.01, type=float)
+
+# the default number of candidates returned for a request
+parser.add_argument('-top_k', default=5, type=int)
+
+# the largest beam size and max number of hypothesis expansions a request may ask for, the
+# requests over them are rejected. default to -beam_size, and -max_beam_size times -decode_max_time_step
+parser.add_argument('-max_beam_size', default=None, type=int)
+parser.add_argument('-max_request_expansion_num', default=None, type=int)
+
+# serve plain HTTP on -host:-port, or JSON lines on the unix socket -unix_socket if given
+parser.add_argument('-host', default='127.0.0.1')
+parser.add_argument('-port', default=8000, type=int)
+parser.add_argument('-unix_socket', default=None)
+
+# the number of worker processes forked after the model is loaded, sharing it copy-on-write.
+# each request is dispatched to an idle worker, which decodes one request at a time, so
+# -batch_window and -decode_batch_size only apply with 0, which decodes in the server process
+parser.add_argument('-workers', default=0, type=int)
+
+# the number of recent requests that the latency statistics are computed over
+parser.add_argument('-stats_window', default=1000, type=int)
+
+
+class DecodeRequest(object):
+    """
+    a query waiting to be decoded, with the timing of each stage
+    """
+    def __init__(self, query, example, str_map, beam_size, top_k, budget):
+        self.query = query
+        self.example = example
+        self.str_map = str_map
+        self.beam_size = beam_size
+        self.top_k = top_k
+        self.budget = budget
+
+        self.arrival_time = time.time()
+        self.decode_begin_time = None
+        self.decode_end_time = None
+        self.queue_depth = 0
+        self.batch_size = 0
+
+        self.cand_list = None
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def queue_time(self):
+        return self.decode_begin_time - self.arrival_time
+
+    @property
+    def decode_time(self):
+        return self.decode_end_time - self.decode_begin_time
+
+    @property
+    def latency(self):
+        return self.decode_end_time - self.arrival_time
+
+
+class BatchDecoder(object):
+    """
+    decode the queued requests on a single thread. The requests arriving within `batch_window`
+    seconds after the first one of a batch, up to `max_batch_size` requests with the same beam
+    size, are decoded together, so that they share the decoder step calls
+    """
+    def __init__(self, model, grammar, annot_vocab, terminal_vocab,
+                 max_batch_size, batch_window, stats_window=1000):
+        self.model = model
+        self.grammar = grammar
+        self.annot_vocab = annot_vocab
+        self.terminal_vocab = terminal_vocab
+
+        self.max_batch_size = max(max_batch_size, 1)
+        self.batch_window = batch_window
+
+        self.pending = []
+        self.cond = threading.Condition()
+
+        # statistics
+        self.request_num = 0
+        self.batch_num = 0
+        self.batched_request_num = 0
+        self.latencies = deque(maxlen=stats_window)
+        self.queue_times = deque(maxlen=stats_window)
+        self.decode_times = deque(maxlen=stats_window)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='batch_decoder')
+        thread.daemon = True
+        thread.start()
+
+    def make_request(self, query, beam_size=None, top_k=None, timeout=None, max_expansion_num=None):
+        query, str_map = canonicalize_query(query)
+        query_tokens = query.split(' ')
+        query_tokens_data = [query_to_data(query, self.annot_vocab)]
+        example = Example(query=query_tokens, data=query_tokens_data)
+
+        if timeout is None:
+            timeout = config.decode_timeout or None
+        if max_expansion_num is None:
+            max_expansion_num = config.decode_max_expansion_num or None
+        budget = DecodeBudget(timeout=timeout, max_expansion_num=max_expansion_num)
+
+        return DecodeRequest(query, example, str_map,
+                             beam_size or config.beam_size, top_k or config.top_k, budget)
+
+    def submit(self, request):
+        with self.cond:
+            request.queue_depth = len(self.pending)
+            self.pending.append(request)
+            self.request_num += 1
+            self.cond.notify()
+
+    def decode(self, query, **kwargs):
+        """
+        decode a query and wait for the result, return the finished `DecodeRequest`
+        """
+        request = self.make_request(query, **kwargs)
+        self.submit(request)
+        request.done.wait()
+
+        return request
+
+    def next_batch(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+
+            # wait for more requests until the batch window of the oldest request ends
+            window_end = self.pending[0].arrival_time + self.batch_window
+            while len(self.pending) < self.max_batch_size:
+                remaining_time = window_end - time.time()
+                if remaining_time <= 0:
+                    break
+                self.cond.wait(remaining_time)
+
+            beam_size = self.pending[0].beam_size
+            batch = [request for request in self.pending if request.beam_size == beam_size][:self.max_batch_size]
+            batch_ids = set(id(request) for request in batch)
+            self.pending = [request for request in self.pending if id(request) not in batch_ids]
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            self.decode_batch(batch)
+
+    def decode_batch(self, batch):
+        decode_begin_time = time.time()
+        for request in batch:
+            request.decode_begin_time = decode_begin_time
+            request.batch_size = len(batch)
+
+        cand_lists = self.decode_requests(batch)
+        for request, cand_list in zip(batch, cand_lists):
+            if cand_list is None:
+                request.error = 'decoding failed'
+
+        decode_end_time = time.time()
+
+        with self.cond:
+            self.batch_num += 1
+            self.batched_request_num += len(batch)
+
+            for request, cand_list in zip(batch, cand_lists):
+                request.decode_end_time = decode_end_time
+                request.cand_list = cand_list
+
+                self.latencies.append(request.latency)
+                self.queue_times.append(request.queue_time)
+                self.decode_times.append(request.decode_time)
+
+        for request in batch:
+            request.done.set()
+
+    def decode_requests(self, batch):
+        """
+        the candidate lists of the requests in `batch`, None for the failed ones. If decoding
+        the batch fails, each request is decoded on its own, so that only the bad ones fail
+        """
+        try:
+            return self.model.decode_batch([request.example for request in batch],
+                                           self.grammar, self.terminal_vocab,
+                                           beam_size=batch[0].beam_size,
+                                           max_time_step=config.decode_max_time_step,
+                                           budgets=[request.budget for request in batch])
+        except Exception:
+            if len(batch) == 1:
+                logging.exception('fail to decode query [%s]', batch[0].query)
+                return [None]
+
+            logging.exception('fail to decode a batch of %d requests, decode them one by one', len(batch))
+            return [self.decode_requests([request])[0] for request in batch]
+
+    def stats(self):
+        with self.cond:
+            stats = {'queue_depth': len(self.pending),
+                     'request_num': self.request_num,
+                     'batch_num': self.batch_num,
+                     'avg_batch_size': self.batched_request_num / float(max(self.batch_num, 1)),
+                     'max_batch_size': self.max_batch_size,
+                     'batch_window': self.batch_window}
+
+            for name, times in [('latency', self.latencies), ('queue_time', self.queue_times),
+                                ('decode_time', self.decode_times)]:
+                if times:
+                    stats[name + '_p50'] = float(np.percentile(times, 50))
+                    stats[name + '_p99'] = float(np.percentile(times, 99))
+                    stats[name + '_avg'] = float(np.average(times))
+
+        return stats
+
+
+def cand_to_code(cand, str_map):
+    if config.data_type == 'ifttt':
+        return repr(cand.tree)
+
+    from lang.py.parse import decode_tree_to_python_ast
+
+    ast_tree = decode_tree_to_python_ast(cand.tree)
+    code = astor.to_source(ast_tree).strip()
+
+    return decanonicalize_code(code, str_map)
+
+
+def error_response(message, code=400):
+    """
+    an error response with the HTTP status `code`, 4xx for bad requests and 5xx for server errors
+    """
+    return {'error': message, 'code': code}
+
+
+def request_to_response(request):
+    """
+    the top candidates of a finished request as code strings with scores, and its timing
+    """
+    if request.error:
+        return error_response(request.error, 500)
+
+    cands = []
+    for cand in request.cand_list[:request.top_k]:
+        try:
+            code = cand_to_code(cand, request.str_map)
+        except:
+            logging.debug('fail to convert the tree to code: %s', traceback.format_exc())
+            code = None
+
+        cands.append({'code': code, 'score': float(cand.score), 'n_timestep': cand.n_timestep})
+
+    return {'query': request.query,
+            'candidates': cands,
+            'status': request.budget.status,
+            'budget': request.budget.report(),
+            'latency': request.latency,
+            'queue_time': request.queue_time,
+            'decode_time': request.decode_time,
+            'queue_depth': request.queue_depth,
+            'batch_size': request.batch_size}
+
+
+def check_json_request(json_request):
+    """
+    the error response to a malformed json request, None if it is well formed
+    """
+    if not isinstance(json_request, dict):
+        return error_response('the request is not a json object')
+
+    if json_request.get('stats'):
+        return None
+
+    query = json_request.get('query')
+    if not query or not isinstance(query, basestring):
+        return error_response('no query')
+
+    for name in ['beam_size', 'top_k', 'max_expansion_num']:
+        value = json_request.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, long)) or value <= 0):
+            return error_response('%s is not a positive integer' % name)
+
+    # the state of each hypothesis in the beam is allocated up front, so large beams could exhaust the memory
+    beam_size = json_request.get('beam_size') or config.beam_size
+    if beam_size > config.max_beam_size:
+        return error_response('beam_size is over the limit %d' % config.max_beam_size)
+
+    if json_request.get('top_k', 0) > beam_size:
+        return error_response('top_k is over the beam size %d' % beam_size)
+
+    if json_request.get('max_expansion_num', 0) > config.max_request_expansion_num:
+        return error_response('max_expansion_num is over the limit %d' % config.max_request_expansion_num)
+
+    timeout = json_request.get('timeout')
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, long, float)) or timeout <= 0):
+        return error_response('timeout is not a positive number')
+
+    return None
+
+
+def handle_json_request(decoder, json_request):
+    """
+    serve a request decoded from json: {"query": "...", "top_k": 5, "beam_size": 15,
+    "timeout": 1.0, "max_expansion_num": 5000} with only the query required,
+    or {"stats": true} for the statistics of the server
+    """
+    error = check_json_request(json_request)
+    if error:
+        return error
+
+    if json_request.get('stats'):
+        return decoder.stats()
+
+    query = json_request['query']
+    if isinstance(query, unicode):
+        query = query.encode('utf-8')
+
+    try:
+        request = decoder.decode(query,
+                                 beam_size=json_request.get('beam_size'),
+                                 top_k=json_request.get('top_k'),
+                                 timeout=json_request.get('timeout'),
+                                 max_expansion_num=json_request.get('max_expansion_num'))
+    except Exception:
+        logging.exception('fail to serve query [%s]', query)
+        return error_response('fail to process the query', 500)
+
+    return request_to_response(request)
+
+
+class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST /decode with a json request, GET /stats for the statistics
+    """
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.handle_json_request({'stats': True}))
+        else:
+            self.send_json(404, error_response('not found', 404))
+
+    def do_POST(self):
+        if self.path != '/decode':
+            self.send_json(404, error_response('not found', 404))
+            return
+
+        try:
+            content_length = int(self.headers.getheader('content-length', 0))
+            json_request = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            self.send_json(400, error_response('invalid json'))
+            return
+
+        response = self.server.handle_json_request(json_request)
+        self.send_json(response.get('code', 200), response)
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class JSONLinesRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    read a json request per line, and write a json response per line
+    """
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                response = self.server.handle_json_request(json.loads(line))
+            except ValueError:
+                response = error_response('invalid json')
+
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixStreamServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Worker(object):
+    """
+    the server side of the connection to a worker process
+    """
+    def __init__(self, worker_id, pid, sock):
+        self.worker_id = worker_id
+        self.pid = pid
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        self.wfile = sock.makefile('wb')
+        self.request_num = 0
+
+    def request(self, json_request):
+        self.wfile.write(json.dumps(json_request) + '\n')
+        self.wfile.flush()
+        line = self.rfile.readline()
+        if not line:
+            raise IOError('worker %d [pid %d] exited' % (self.worker_id, self.pid))
+
+        self.request_num += 1
+
+        return json.loads(line)
+
+    def close(self):
+        for f in [self.rfile, self.wfile, self.sock]:
+            f.close()
+
+
+def run_worker(decoder, sock):
+    """
+    the loop of a worker process, answer a json request per line from `sock`
+    """
+    # a worker only gets a request when idle, so it decodes one request at a time
+    decoder.max_batch_size = 1
+    decoder.start()
+
+    rfile = sock.makefile('rb')
+    wfile = sock.makefile('wb')
+    for line in iter(rfile.readline, ''):
+        response = handle_json_request(decoder, json.loads(line))
+        wfile.write(json.dumps(response) + '\n')
+        wfile.flush()
+
+
+class WorkerPool(object):
+    """
+    fork `worker_num` worker processes from the process that has loaded the model. The workers
+    share the memory-mapped weights, the compiled functions, the grammar and the vocabs with the
+    parent copy-on-write, and decode on their own cores. Each request is dispatched to an idle
+    worker, or waits in the queue until one is free. A worker decodes one request at a time, so
+    the requests are not batched. A failed worker is removed, and once no worker is left,
+    the requests are answered with an error
+    """
+    def __init__(self, decoder, worker_num, stats_window=1000):
+        self.idle_workers = Queue.Queue()
+        self.workers = []
+        self.live_worker_num = 0
+
+        self.lock = threading.Lock()
+        self.queue_depth = 0
+        self.request_num = 0
+        self.latencies = deque(maxlen=stats_window)
+        self.queue_times = deque(maxlen=stats_window)
+
+        # collect the garbage before forking, so that each worker does not copy the pages to free it
+        gc.collect()
+
+        for worker_id in xrange(worker_num):
+            parent_sock, worker_sock = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                parent_sock.close()
+                for worker in self.workers:
+                    worker.close()
+
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                try:
+                    run_worker(decoder, worker_sock)
+                except:
+                    logging.exception('worker %d exits on error', worker_id)
+                finally:
+                    os._exit(0)
+
+            worker_sock.close()
+            worker = Worker(worker_id, pid, parent_sock)
+            self.workers.append(worker)
+            self.idle_workers.put(worker)
+            self.live_worker_num += 1
+
+            logging.info('forked worker %d [pid %d]', worker_id, pid)
+
+    def handle_json_request(self, json_request):
+        error = check_json_request(json_request)
+        if error:
+            return error
+
+        if json_request.get('stats'):
+            return self.stats()
+
+        arrival_time = time.time()
+        with self.lock:
+            queue_depth = self.queue_depth
+            self.queue_depth += 1
+            self.request_num += 1
+
+        worker = self.get_idle_worker()
+        with self.lock:
+            self.queue_depth -= 1
+        dispatch_time = time.time()
+
+        if worker is None:
+            return error_response('no live worker', 503)
+
+        try:
+            response = worker.request(json_request)
+        except (IOError, ValueError):
+            logging.exception('fail to get the response from worker %d', worker.worker_id)
+            self.remove_worker(worker)
+            return error_response('worker failed', 500)
+
+        self.idle_workers.put(worker)
+
+        latency = time.time() - arrival_time
+        with self.lock:
+            self.latencies.append(latency)
+            self.queue_times.append(dispatch_time - arrival_time)
+
+        if 'error' not in response:
+            response['latency'] = latency
+            response['queue_time'] += dispatch_time - arrival_time
+            response['queue_depth'] = queue_depth
+            response['worker'] = worker.worker_id
+
+        return response
+
+    def get_idle_worker(self):
+        """
+        wait for an idle worker, None if no worker is left
+        """
+        worker = self.idle_workers.get()
+        if worker is None:
+            # wake up the next waiting request
+            self.idle_workers.put(None)
+
+        return worker
+
+    def remove_worker(self, worker):
+        """
+        close the connection to a failed worker, and kill and reap its process
+        """
+        worker.close()
+        try:
+            os.kill(worker.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            os.waitpid(worker.pid, 0)
+        except OSError:
+            pass
+
+        with self.lock:
+            self.live_worker_num -= 1
+            live_worker_num = self.live_worker_num
+
+        logging.error('removed worker %d [pid %d], %d workers left', worker.worker_id, worker.pid, live_worker_num)
+
+        if live_worker_num == 0:
+            # wake up the requests waiting for a worker
+            self.idle_workers.put(None)
+
+    def stats(self):
+        with self.lock:
+            stats = {'queue_depth': self.queue_depth,
+                     'request_num': self.request_num,
+                     'worker_num': len(self.workers),
+                     'live_worker_num': self.live_worker_num,
+                     'idle_worker_num': min(self.idle_workers.qsize(), self.live_worker_num),
+                     'worker_request_nums': [worker.request_num for worker in self.workers]}
+
+            for name, times in [('latency', self.latencies), ('queue_time', self.queue_times)]:
+                if times:
+                    stats[name + '_p50'] = float(np.percentile(times, 50))
+                    stats[name + '_p99'] = float(np.percentile(times, 99))
+                    stats[name + '_avg'] = float(np.average(times))
+
+        return stats
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+                os.waitpid(worker.pid, 0)
+            except OSError:
+                pass
+
+
+def make_server(handle_json_request, args):
+    """
+    a server answering each json request with `handle_json_request`
+    """
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+        server = ThreadingUnixStreamServer(args.unix_socket, JSONLinesRequestHandler)
+        logging.info('serving json lines on unix socket [%s]', args.unix_socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), HTTPRequestHandler)
+        logging.info('serving http on %s:%d', args.host, args.port)
+
+    server.handle_json_request = handle_json_request
+
+    return server
+
+
+def load_decoder(args):
+    """
+    set the config from `args`, and load the model in the inference bundle
+    into a batch decoder, which is not started yet
+    """
+    if args.max_beam_size is None:
+        args.max_beam_size = args.beam_size
+    if args.max_request_expansion_num is None:
+        args.max_request_expansion_num = args.max_beam_size * args.decode_max_time_step
+
+    config_module = sys.modules['config']
+    for name, value in vars(args).iteritems():
+        setattr(config_module, name, value)
+
+    begin_time = time.time()
+    model, grammar, annot_vocab, terminal_vocab = load_bundle(args.bundle)
+    logging.info('model built in %.2fs', time.time() - begin_time)
+
+    decoder = BatchDecoder(model, grammar, annot_vocab, terminal_vocab,
+                           args.decode_batch_size, args.batch_window, args.stats_window)
+
+    return decoder
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    init_logging('server.log', logging.INFO)
+
+    decoder = load_decoder(args)
+
+    pool = None
+    if args.workers > 0:
+        # fork the workers before any thread is started
+        pool = WorkerPool(decoder, args.workers, args.stats_window)
+        server = make_server(pool.handle_json_request, args)
+    else:
+        decoder.start()
+        server = make_server(lambda json_request: handle_json_request(decoder, json_request), args)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if pool:
+            pool.close()
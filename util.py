@@ -1,4 +1,28 @@
+import numpy as np
+
+
 def is_numeric(s):
     if s[0] in ('-', '+'):
         return s[1:].isdigit()
-    return s.isdigit()
\ No newline at end of file
+    return s.isdigit()
+
+
+def top_k_ids(scores, k):
+    """
+    the ids of the `k` largest scores in descending order, where ties are broken
+    by the lower id. same as `np.argsort(-scores, kind='mergesort')[:k]`, but only
+    the scores no less than the k-th largest one are sorted
+    """
+    if k <= 0:
+        return np.zeros(0, dtype='int64')
+
+    if k < len(scores):
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        ids = np.flatnonzero(scores >= threshold)
+    else:
+        ids = np.arange(len(scores))
+
+    # lexsort uses the last key as the primary key
+    order = np.lexsort((ids, -scores[ids]))
+
+    return ids[order[:k]]